@@ -4,6 +4,9 @@ This package provides function to analysis fMRI data.
 fctools:
   calculate functional connectivity(wsfc, isfc, etc.).
 
+permtools:
+  significance testing of ISC/ISFC by permutation and bootstrap.
+
 evaltools:
   provide tools for evaluating effect of parcellation / clustering result.
 
@@ -1,10 +1,17 @@
+import heapq
+import multiprocessing
+
 import numpy as np
+from scipy import sparse
 from scipy.spatial.distance import cdist
-from sklearn.metrics.pairwise import rbf_kernel
 from sklearn.neighbors import kneighbors_graph
-from sklearn.cluster import KMeans, AgglomerativeClustering, SpectralClustering
+from sklearn.cluster import KMeans, MiniBatchKMeans, AgglomerativeClustering, SpectralClustering
 
 from nsnt.utils.utils import running_time
+from nsnt.algorithms.fctools import normalize_rows
+from nsnt.utils.adj_tools import SurfaceGeometry
+from nsnt.utils.mask_tools import VertexMask
+from nsnt.utils.pool_tools import shared_map
 
 
 class Clustering(object):
@@ -18,28 +25,54 @@ class Clustering(object):
           shape: (n_vertexes, )
     """
 
-    def __init__(self, data, mask):
+    def __init__(self, data, mask=None):
         self.data = np.nan_to_num(data)
         self.mask = mask
         self.method = None
         self.label = None
+        self._vertex_mask = None
 
-        if self.mask:
+        if self.mask is not None:
             self._apply_mask()
 
-    def fit(self, parcel_num, method):
+    def fit(self, parcel_num, method, adj=None, eigen_solver="arpack", random_state=None):
+        """
+        Doing clustering, see self.label for the result.
+
+        Parameters
+        ----------
+        parcel_num: the number of clusters, type: int.
+        method: 'KMeans', 'hier_clustering', 'spectral_clustering' or 'region_growing'.
+        adj: SurfaceGeometry or adjacency matrix(array or sparse) of vertexes, used as adjacency
+             constraint if it's not None, default is None.
+             If shape of adjacency matrix matches the data before mask, mask will be applied on it.
+             'hier_clustering': ward with sparse connectivity.
+             'spectral_clustering': affinity is calculated on adjacent vertexes only, see adj_affinity().
+             'region_growing': needs adj.
+        eigen_solver: used in 'spectral_clustering', see _do_spectral().
+        random_state: seed of random number generator used in 'KMeans', 'spectral_clustering' and
+                      'region_growing', default is None.
+        """
         self.method = method
         self.label = None
+        adjm = None if adj is None else self._get_connectivity(adj)
 
         # doing clustering
         if self.method == 'KMeans':
-            self._do_kmeans(parcel_num)
+            self._do_kmeans(parcel_num, random_state=random_state)
 
         elif self.method == "hier_clustering":
-            self._do_hier(parcel_num)
+            self._do_hier(parcel_num, adj=adjm)
 
         elif self.method == "spectral_clustering":
-            self._do_spectral(parcel_num, affinity="precomputed")
+            smat = None if adjm is None else adj_affinity(self.data, adjm)
+            self._do_spectral(parcel_num, eigen_solver=eigen_solver, affinity="precomputed", smat=smat,
+                              random_state=random_state)
+
+        elif self.method == "region_growing":
+            if adjm is None:
+                raise ValueError("region_growing needs adjacency, please set adj.")
+            self._do_region_growing(parcel_num, adjm, random_state=random_state)
 
         else:
             raise Exception("Wrong method name.")
@@ -47,23 +80,72 @@ class Clustering(object):
         self._rebuild_label(parcel_num)
         self.show_labelinfo()
 
+    def _get_connectivity(self, adj):
+        """
+        Get sparse adjacency matrix(CSR) that matches self.data.
+
+        Parameters
+        ----------
+        adj: SurfaceGeometry or adjacency matrix(array or sparse) of vertexes.
+        """
+        if isinstance(adj, SurfaceGeometry):
+            adj = adj.adjmatrix
+        adjm = sparse.csr_matrix(adj)
+        if self._vertex_mask is not None and adjm.shape[0] == self._vertex_mask.n_vertices != self.data.shape[0]:
+            adjm = self._vertex_mask.compress_adjmatrix(adjm)
+        assert adjm.shape == (self.data.shape[0],) * 2, \
+            'Shape of adjacency matrix {0} does not match data {1}.'.format(adjm.shape, self.data.shape)
+        return adjm
+
+    def fit_kmeans_repeated(self, parcel_num, seeds, minibatch=False, n_init=1, n_jobs=1):
+        """
+        Doing KMeans clustering repeatedly with different seeds, used for consensus clustering.
+        Repeats are run in a process pool, and data is shared by worker processes as a read-only buffer.
+
+        Parameters
+        ----------
+        parcel_num: the number of clusters, type: int.
+        seeds: list of random seeds, one repeat for every seed.
+        minibatch: whether use MiniBatchKMeans or not, which is faster for large data, default is False.
+        n_init: number of initializations in every repeat, default is 1.
+        n_jobs: number of worker processes, default is 1.
+
+        Return
+        ------
+        labels: clustering results, vertexes out of mask are assigned parcel_num,
+                shape: (n_seeds, n_vertexes), dtype: int32.
+        """
+        self.method = 'MiniBatchKMeans' if minibatch else 'KMeans'
+        tasks = [(parcel_num, seed, minibatch, n_init) for seed in seeds]
+        if n_jobs == 1:
+            results = list(shared_map(_run_kmeans, tasks, shared=self.data))
+        else:
+            buffer = multiprocessing.RawArray('d', self.data.size)
+            np.frombuffer(buffer).reshape(self.data.shape)[:] = self.data
+            results = list(shared_map(_run_kmeans, tasks, shared=(buffer, self.data.shape),
+                                      initializer=_buffer_to_array, n_jobs=n_jobs))
+
+        labels = np.array([self._rebuild_label(parcel_num, label=label) for label in results], dtype=np.int32)
+        self.label = labels[-1]
+        return labels
+
     @running_time
-    def _do_kmeans(self, n_clusters):
+    def _do_kmeans(self, n_clusters, random_state=None, minibatch=False, n_init=10):
         """
         Doing KMeans clustering, see self.label for the result.
 
         Parameters
         ----------
         n_clusters: the number of clusters, type: int.
+        random_state: seed of random number generator, default is None.
+        minibatch: whether use MiniBatchKMeans or not, default is False.
+        n_init: number of initializations, default is 10.
 
         Return
         ------
         label: clustering result, shape: (n_vertexes,)
         """
-        kmeans = KMeans(n_clusters=n_clusters)
-        kmeans.fit(self.data)
-        self.label = kmeans.predict(self.data)
-
+        self.label = _kmeans_labels(self.data, n_clusters, random_state, minibatch, n_init)
         return self.label
 
     @running_time
@@ -86,13 +168,10 @@ class Clustering(object):
             model = AgglomerativeClustering(n_clusters=n_clusters, linkage="ward")
         model.fit(self.data)
         self.label = model.labels_
-
-        self._rebuild_label(n_clusters)
-        self.show_labelinfo()
         return self.label
 
     @running_time
-    def _do_spectral(self, n_clusters, eigen_solver="arpack", affinity="rbf"):
+    def _do_spectral(self, n_clusters, eigen_solver="arpack", affinity="rbf", smat=None, random_state=None):
         """
         Doing spectral clustering, see self.label for the result.
         This method calculate similarity matrix of data first, then use this smat as input for
@@ -104,28 +183,77 @@ class Clustering(object):
         n_clusters: the number of clusters, type: int.
         eigen_solver: The eigenvalue decomposition strategy to use, default is 'arpack'.
                       For more information, see help(sklearn.cluster.SpectralClustering).
+                      'amg'(needs pyamg) or 'lobpcg' is recommended for large sparse smat.
         affinity: Only kernels that produce similarity scores (non-negative values that
                   increase with similarity) should be used, default is 'rbf'.
+        smat: precomputed similarity matrix, array or sparse matrix, see knn_affinity() and adj_affinity(),
+              default is None, means calculated by the formula above.
+              If given, affinity should be 'precomputed'.
+        random_state: seed of random number generator used in eigen decomposition and k-means,
+                      default is None.
 
         Return
         ------
         label: clustering result, shape: (n_vertexes,)
         """
-        beta = 0.1  # used in spectral clustering
-        smat = cal_edist_mat(self.data, beta=beta)
+        if smat is None:
+            beta = 0.1  # used in spectral clustering
+            smat = cal_edist_mat(self.data, beta=beta)
 
-        spectral_cluster = SpectralClustering(n_clusters=n_clusters, eigen_solver=eigen_solver, affinity=affinity)
+        spectral_cluster = SpectralClustering(n_clusters=n_clusters, eigen_solver=eigen_solver, affinity=affinity,
+                                             random_state=random_state)
         self.label = spectral_cluster.fit(X=smat).labels_
+        return self.label
 
-        self._rebuild_label(n_clusters)
-        self.show_labelinfo()
+    @running_time
+    def _do_region_growing(self, n_clusters, adjm, random_state=None):
+        """
+        Doing region growing clustering, see self.label for the result.
+        Seeds are chosen by k-means++ on normalized data, then regions grow from seeds on the surface,
+            the unassigned neighbor that most correlated with seed of its region is assigned first.
+        Vertexes that can not be reached from any seed are assigned to the most correlated seed.
+
+        Parameters
+        ----------
+        n_clusters: the number of clusters, type: int.
+        adjm: sparse adjacency matrix of vertexes, shape: (n_vertexes, n_vertexes).
+        random_state: seed of random number generator used to choose seeds, default is None.
+
+        Return
+        ------
+        label: clustering result, shape: (n_vertexes,)
+        """
+        from sklearn.cluster import kmeans_plusplus
+
+        norm_data = normalize_rows(self.data)
+        _, seeds = kmeans_plusplus(norm_data, n_clusters, random_state=random_state)
+
+        adjm = sparse.csr_matrix(adjm)
+        label = -np.ones(norm_data.shape[0], dtype=int)
+        heap = [(-1.0, seed, i) for i, seed in enumerate(seeds)]
+        heapq.heapify(heap)
+        while heap:
+            _, vertex, region = heapq.heappop(heap)
+            if label[vertex] != -1:
+                continue
+            label[vertex] = region
+            neighbors = adjm.indices[adjm.indptr[vertex]:adjm.indptr[vertex + 1]]
+            neighbors = neighbors[label[neighbors] == -1]
+            similarity = np.dot(norm_data[neighbors], norm_data[seeds[region]])
+            for neighbor, sim in zip(neighbors, similarity):
+                heapq.heappush(heap, (-sim, neighbor, region))
+
+        unreached = np.where(label == -1)[0]
+        if unreached.shape[0]:
+            label[unreached] = np.argmax(np.dot(norm_data[unreached], norm_data[seeds].T), axis=1)
+        self.label = label
         return self.label
 
     def show_labelinfo(self):
         """
         Print information of labels, do clustering first.
         """
-        if self.method and self.label:
+        if self.method and self.label is not None:
             print('Clustering method: {}'.format(self.method))
             print('Shape of labels: {}'.format(np.shape(self.label)))
             print('Max label index: {}'.format(np.max(self.label)))
@@ -147,14 +275,14 @@ class Clustering(object):
         if self.data.shape[0] != self.mask.shape[0]:
             print('Shape of data and mask is not match, apply mask failed.')
             return -1
-        zeros = np.where(self.mask == 0)[0]
-        data = np.delete(self.data, zeros, axis=0)
+        self._vertex_mask = VertexMask(np.reshape(self.mask, (-1)) != 0)
+        data = self._vertex_mask.compress(self.data)
         del_num = self.data.shape[0] - data.shape[0]
         print("Delete %i vertexes from data." % del_num)
         print("Shape of data after del zeros: {0.shape}".format(data))
         self.data = data
 
-    def _rebuild_label(self, index):
+    def _rebuild_label(self, index, label=None):
         """
         Rebuild labels based on mask, and assign vertexes that out of mask an label index.
 
@@ -162,12 +290,124 @@ class Clustering(object):
         ----------
         index: assign index to vertexes that are out of mask, which means vertexes that \
                were deleted by self._apply_mask().
+        label: labels to rebuild, default is None, means rebuild self.label in place.
+
+        Return
+        ------
+        label: labels after rebuilding.
         """
-        zeros = np.where(self.mask == 0)[0]
-        label = self.label
-        for i in zeros:
-            label = np.insert(label, i, index)  # KMeans create label number range: (0, parcel_num-1)
-        self.label = label
+        if label is None:
+            self.label = self._rebuild_label(index, label=self.label)
+            return self.label
+        if self._vertex_mask is None:
+            return label
+        # KMeans create label number range: (0, parcel_num-1)
+        return self._vertex_mask.expand(label, fill=index)
+
+
+def _kmeans_labels(data, n_clusters, random_state=None, minibatch=False, n_init=10):
+    """Doing KMeans(or MiniBatchKMeans) clustering and get labels by fit_predict()."""
+    if minibatch:
+        model = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, n_init=n_init)
+    else:
+        model = KMeans(n_clusters=n_clusters, random_state=random_state, n_init=n_init)
+    return model.fit_predict(data)
+
+
+def _buffer_to_array(shared):
+    """Get data from shared buffer in worker process of Clustering.fit_kmeans_repeated()."""
+    buffer, shape = shared
+    return np.frombuffer(buffer).reshape(shape)
+
+
+def _run_kmeans(data, task):
+    n_clusters, seed, minibatch, n_init = task
+    return _kmeans_labels(data, n_clusters, seed, minibatch, n_init)
+
+
+def _pair_affinity(data, rows, columns, kernel="rbf", gamma=None, chunk_size=100000):
+    """
+    Calculate affinity of vertex pairs (rows[i], columns[i]) only.
+
+    Parameters
+    ----------
+    data: input 2-d array.
+    rows, columns: index of vertex pairs, shape: (n_pairs,).
+    kernel: 'rbf' or 'correlation'.
+        'rbf': exp(-gamma * |x - y|^2), gamma is 1 / n_features if it's None.
+        'correlation': pearson correlation, negative values are set to 0.
+    gamma: parameter of rbf kernel.
+    chunk_size: number of pairs calculated together, used to limit memory.
+
+    Return
+    ------
+    affinity: affinity of vertex pairs, shape: (n_pairs,).
+    """
+    if kernel == "correlation":
+        data = normalize_rows(data)
+    elif kernel == "rbf":
+        if gamma is None:
+            gamma = 1.0 / data.shape[1]
+    else:
+        raise ValueError("kernel could only be 'rbf' or 'correlation'.")
+
+    affinity = np.empty(rows.shape[0])
+    for start in range(0, rows.shape[0], chunk_size):
+        pair = slice(start, start + chunk_size)
+        if kernel == "correlation":
+            affinity[pair] = np.maximum(np.sum(data[rows[pair]] * data[columns[pair]], axis=1), 0)
+        else:
+            affinity[pair] = np.exp(-gamma * np.sum((data[rows[pair]] - data[columns[pair]]) ** 2, axis=1))
+    return affinity
+
+
+def _graph_affinity(data, graph, kernel, gamma):
+    """Calculate affinity on nonzero entries of graph, return symmetric sparse matrix(CSR)."""
+    graph = sparse.coo_matrix(graph)
+    affinity = _pair_affinity(data, graph.row, graph.col, kernel=kernel, gamma=gamma)
+    affinity = sparse.csr_matrix((affinity, (graph.row, graph.col)), shape=graph.shape)
+    affinity = 0.5 * (affinity + affinity.T)
+    affinity.eliminate_zeros()
+    return affinity.tocsr()
+
+
+def knn_affinity(data, k=10, kernel="rbf", gamma=None):
+    """
+    Build sparse affinity matrix of k nearest neighbors, affinity is calculated on neighbor pairs only.
+
+    Parameters
+    ----------
+    data: input 2-d array, shape: (n_vertexes, n_features).
+    k: the number of nearest neighbors, default is 10.
+    kernel: 'rbf' or 'correlation', see _pair_affinity(), default is 'rbf'.
+    gamma: parameter of rbf kernel, default is None, means 1 / n_features.
+
+    Return
+    ------
+    affinity: symmetric sparse matrix(CSR), shape: (n_vertexes, n_vertexes).
+    """
+    nbrs = kneighbors_graph(X=data, n_neighbors=k, metric="correlation" if kernel == "correlation" else "minkowski")
+    return _graph_affinity(data, nbrs, kernel, gamma)
+
+
+def adj_affinity(data, adjm, kernel="rbf", gamma=None):
+    """
+    Build sparse affinity matrix restricted to surface neighborhood,
+        affinity is calculated on adjacent vertex pairs only.
+
+    Parameters
+    ----------
+    data: input 2-d array, shape: (n_vertexes, n_features).
+    adjm: adjacency matrix of vertexes, array or sparse matrix, see SurfaceGeometry.adjmatrix,
+        shape: (n_vertexes, n_vertexes).
+    kernel: 'rbf' or 'correlation', see _pair_affinity(), default is 'rbf'.
+    gamma: parameter of rbf kernel, default is None, means 1 / n_features.
+
+    Return
+    ------
+    affinity: symmetric sparse matrix(CSR), shape: (n_vertexes, n_vertexes).
+    """
+    return _graph_affinity(data, adjm, kernel, gamma)
 
 
 @running_time
@@ -183,14 +423,9 @@ def cal_knn_mat(data, k=10):
 
     Return
     ------
-    knn_mat: k nearest neighbor matrix.
+    knn_mat: k nearest neighbor matrix, use knn_affinity() if sparse matrix is needed.
     """
-    rbf_mat = rbf_kernel(data)
-    nbrs = kneighbors_graph(X=data, n_neighbors=k)
-    knn_mat = nbrs.toarray() * rbf_mat
-    knn_mat = 0.5 * (knn_mat + knn_mat.T)
-    # print("gamma: {}".format(np.mean(np.min(rbf_mat[np.where(rbf_mat != 0)], axis=0))))
-    return knn_mat
+    return knn_affinity(data, k=k).toarray()
 
 
 def cal_edist_mat(data, beta=1.0):
@@ -205,9 +440,12 @@ def cal_edist_mat(data, beta=1.0):
 
     Return
     ------
-    smat: asymmetric similarity matrix.
+    smat: symmetric similarity matrix.
     """
-    dist = cdist(data, data)
-    print("std of dist: {}".format(dist.std()))
-    edist = np.exp(-beta * dist / dist.std())
-    return 0.5 * (edist + edist.T)
+    # calculate in place to keep only one (n, n) matrix in memory.
+    smat = cdist(data, data)
+    dist_std = smat.std()
+    print("std of dist: {}".format(dist_std))
+    smat *= -beta / dist_std
+    np.exp(smat, out=smat)
+    return smat
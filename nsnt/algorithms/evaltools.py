@@ -1,14 +1,20 @@
 """
 Used to evaluate clusters or parcellations.
 """
+import csv
+
 import numpy as np
 
-from scipy.stats import zscore
+from scipy import sparse
+from scipy.stats import zscore, norm
 from scipy.spatial.distance import cdist
 
-from nsnt.algorithms.fctools import wsfc
+from nsnt.algorithms.fctools import normalize_rows
 from nsnt.utils.utils import apply_1d_mask
-from nsnt.utils.adj_tools import nonconnected_labels, mk_label_adjfaces, faces_to_dict
+from nsnt.utils.mask_tools import as_vertex_mask
+from nsnt.utils.pool_tools import shared_map
+from nsnt.utils.segment_tools import VoteMatrix, label_onehot, segment_sum, segment_mean, segment_stats
+from nsnt.utils.adj_tools import nonconnected_labels, faces_to_adjmatrix, mk_label_graph, label_components
 
 
 def ari(labels1, labels2, mask=None):
@@ -27,6 +33,7 @@ def ari(labels1, labels2, mask=None):
     """
     from sklearn.metrics.cluster import adjusted_rand_score
 
+    mask = as_vertex_mask(mask)
     labels1 = apply_1d_mask(labels1, mask)
     labels2 = apply_1d_mask(labels2, mask)
     return adjusted_rand_score(labels1, labels2)
@@ -48,11 +55,49 @@ def ami(labels1, labels2, mask=None):
     """
     from sklearn.metrics.cluster import adjusted_mutual_info_score
 
+    mask = as_vertex_mask(mask)
     labels1 = apply_1d_mask(labels1, mask)
     labels2 = apply_1d_mask(labels2, mask)
     return adjusted_mutual_info_score(labels1, labels2)
 
 
+def _homogeneity(data, labels, norm_data=None):
+    """
+    Cal homogeneity of labels and vertices by sum of normalized data in every label.
+
+    For normalized data z (unit norm), mean correlation of vertex pairs in a label with k vertices is
+        (|sum(z)|^2 - sum(|z|^2)) / (k * (k - 1)), and mean correlation of vertex i with others is
+        (z_i . sum(z) - |z_i|^2) / (k - 1), no functional connectivity matrix is needed.
+
+    If norm_data(data after normalize_rows()) is given, data will not be used.
+
+    Returns
+    -------
+    label_list: a sorted array that contain labels.
+    homo_list: homogeneity list that corresponding to label_list.
+    homo_map: homogeneity of every vertex with other vertex in the same label.
+    label_size: number of vertices in every label.
+    """
+    if norm_data is None:
+        norm_data = normalize_rows(data)
+    label_list, label_index = np.unique(labels, return_inverse=True)
+    label_index = np.reshape(label_index, (-1))
+    _, label_sum, label_size = segment_sum(norm_data, labels)
+    vert_norm = np.sum(norm_data ** 2, axis=1)  # 1 for every vertex, except 0 for zero variance vertex.
+    _, label_norm, _ = segment_sum(vert_norm, labels)
+
+    # some labels may be assigned to only one vertex, whose homogeneity is 1.
+    single = label_size == 1
+    pair_number = np.where(single, 1, label_size * (label_size - 1))
+    homo_list = (np.sum(label_sum ** 2, axis=1) - label_norm) / pair_number
+    homo_list[single] = 1
+
+    others_number = np.where(single, 1, label_size - 1)[label_index]
+    homo_map = (np.sum(norm_data * label_sum[label_index], axis=1) - vert_norm) / others_number
+    homo_map[single[label_index]] = 1
+    return label_list, homo_list, homo_map, label_size
+
+
 def homogeneity_coef(data, labels, label_size_count=False):
     """
     Calculate homogeneity score of labels based on its data.
@@ -67,20 +112,7 @@ def homogeneity_coef(data, labels, label_size_count=False):
     -------
     homo_score: score of homogeneity.
     """
-    label_list = np.unique(labels)
-    homo_list = np.zeros_like(label_list, dtype=np.float64)
-    label_size = np.zeros_like(label_list, dtype=np.int)
-
-    for i, label in enumerate(label_list):
-        vert_list = np.array(np.where(labels == label))[0]
-        vert_num = vert_list.shape[0]
-        label_size[i] = vert_num
-
-        fcmap = np.nan_to_num(wsfc(data[vert_list, :]))
-        if vert_num == 1:  # some labels may be assigned to only one vertex.
-            homo_list[i] = 1
-        else:
-            homo_list[i] = np.mean(fcmap[np.triu_indices_from(fcmap, k=1)])
+    _, homo_list, _, label_size = _homogeneity(data, labels)
     if label_size_count:
         return np.sum(label_size * homo_list) / np.sum(label_size)
     return np.mean(homo_list)
@@ -100,19 +132,9 @@ def homogeneity_list(data, labels):
     label_list: a sorted array that contain labels.
     homo_list: homogeneity list that corresponding to label_list.
     """
-    # here we use unique labels for loop instead of max label number, to avoid error
+    # here we use unique labels instead of max label number, to avoid error
     # caused by discontinuity labels, which may lead to nan in result.
-    label_list = np.unique(labels)
-    homo_list = np.zeros_like(label_list, dtype=np.float64)
-
-    for i, label in enumerate(label_list):
-        vert_list = np.array(np.where(labels == label))[0]
-        vert_num = vert_list.shape[0]
-        fcmap = np.nan_to_num(wsfc(data[vert_list, :]))
-        if vert_num == 1:  # some labels may be assigned to only one vertex.
-            homo_list[i] = 1
-        else:
-            homo_list[i] = np.mean(fcmap[np.triu_indices_from(fcmap, k=1)])
+    label_list, homo_list, _, _ = _homogeneity(data, labels)
     return label_list, homo_list
 
 
@@ -128,34 +150,50 @@ def homogeneity_map(data, labels, mask=None):
 
     Returns
     -------
-    homo_map: homogeneity of every vertex with other vertex in the same label.
+    homo_map: homogeneity of every vertex with other vertex in the same label,
+        homogeneity of vertex in label that has only one vertex is 1.
     """
+    mask = as_vertex_mask(mask)
     data = apply_1d_mask(data, mask)
     labels = apply_1d_mask(labels, mask)
 
-    # here we use unique labels for loop instead of max label number, to avoid error
-    # caused by discontinuity labels which may lead to nan in result.
-    label_list = np.unique(labels)
-    homo_map = np.zeros_like(labels, dtype=np.float64)
-
-    for i, label in enumerate(label_list):
-        vert_list = np.array(np.where(labels == label))[0]
-        vert_num = vert_list.shape[0]
-        fcmap = np.nan_to_num(wsfc(data[vert_list, :]))
-        for j, vert in enumerate(vert_list):
-            # calculate mean homo except vertex itself.
-            homo_map[vert] = (np.sum(fcmap[j]) - 1) / (vert_num - 1)
-    if mask:
-        result = np.copy(mask)
-        result[np.where(mask == 1)] = homo_map
-        return result
+    _, _, homo_map, _ = _homogeneity(data, labels)
+    if mask is not None:
+        return mask.expand(homo_map.astype(np.float64))
     return homo_map
 
 
+def contingency_matrix(labels1, labels2):
+    """
+    Calculate contingency table of the inputs, count vertices of every label pair.
+
+    Parameters
+    ----------
+    labels1: cluster labels, shape = [n_samples].
+    labels2: cluster labels, shape = [n_samples].
+
+    Returns
+    -------
+    label_list1: sorted unique labels of labels1, shape = (label_number1, ).
+    label_list2: sorted unique labels of labels2, shape = (label_number2, ).
+    contingency: sparse matrix(CSR), number of vertices that belong to label_list1[i] and
+        label_list2[j], shape = (label_number1, label_number2).
+    """
+    label_list1, index1 = np.unique(labels1, return_inverse=True)
+    label_list2, index2 = np.unique(labels2, return_inverse=True)
+    index1, index2 = np.reshape(index1, (-1)), np.reshape(index2, (-1))
+    contingency = sparse.csr_matrix((np.ones(index1.shape[0], dtype=np.int64), (index1, index2)),
+                                    shape=(label_list1.shape[0], label_list2.shape[0]))
+    return label_list1, label_list2, contingency
+
+
 def dice_matrix(labels1, labels2):
     """
     Calculate dice similarity coefficient matrix of the inputs.
 
+    Dice of label pair is calculated from contingency table and label sizes,
+        dice = 2 * |A & B| / (|A| + |B|).
+
     Parameters
     ----------
     labels1: cluster labels, shape = [n_samples].
@@ -169,21 +207,14 @@ def dice_matrix(labels1, labels2):
     -----
     1. the label 0 in labels should be assigned to the medial wall, and it will be ommited.
     """
-    from scipy.spatial.distance import dice
-
-    label_list1 = np.unique(labels1)
-    label_list2 = np.unique(labels2)
+    label_list1, label_list2, contingency = contingency_matrix(labels1, labels2)
+    size1 = np.bincount(np.searchsorted(label_list1, np.reshape(labels1, (-1))))
+    size2 = np.bincount(np.searchsorted(label_list2, np.reshape(labels2, (-1))))
 
     # label 0 will not be concerned.
-    label_list1 = label_list1[np.where(label_list1 != 0)]
-    label_list2 = label_list2[np.where(label_list2 != 0)]
-
-    row_num, column_num = np.shape(label_list1)[0], np.shape(label_list2)[0]
-
-    dice_mat = np.zeros((row_num, column_num))
-    for i, l1 in enumerate(label_list1):
-        for j, l2 in enumerate(label_list2):
-            dice_mat[i, j] = 1 - dice(labels1 == l1, labels2 == l2)  # dice() measures dice dissimilarity
+    keep1, keep2 = np.where(label_list1 != 0)[0], np.where(label_list2 != 0)[0]
+    intersection = contingency[keep1][:, keep2].toarray()
+    dice_mat = 2.0 * intersection / (size1[keep1, np.newaxis] + size2[np.newaxis, keep2])
     return np.nan_to_num(dice_mat)
 
 
@@ -211,7 +242,7 @@ def dice_coef(labels1, labels2):
     return dice_coefficient
 
 
-def cdist_coef(data, labels, metric='euclidean', label_size_count=False, doing_zscore=False):
+def cdist_coef(data, labels, metric='euclidean', label_size_count=False, doing_zscore=False, chunk_size=1024):
     """
     Calculate euclidean distance coefficient of labels based on its vertices' cdist.
 
@@ -222,28 +253,43 @@ def cdist_coef(data, labels, metric='euclidean', label_size_count=False, doing_z
     metric: measurement, see help of scipy.spatial.distance.
     label_size_count: whether balance size of label or not.
     doing_zscore: whether doing zscore to data or not.
+    chunk_size: number of vertices whose distances are calculated together,
+        used by metrics other than 'sqeuclidean' and 'correlation', default is 1024.
 
     Returns
     -------
     cdist_coefficient: float, reflects mean dissimilarity, based on metric.
+
+    Notes
+    -----
+    1. only distances within every label are calculated, and for 'sqeuclidean' and 'correlation'
+       they are got from sums of every label, see _label_dist_sums().
     """
     if doing_zscore:
         print('Doing zscore to data.')
-        np.nan_to_num(zscore(data, axis=1))
+        data = np.nan_to_num(zscore(data, axis=1))
 
-    # here we use unique labels for loop instead of max label number, to avoid error
+    # here we use unique labels instead of max label number, to avoid error
     # caused by discontinuity labels, which may lead to nan in result.
-    label_list = np.unique(labels)
-    cdist_list = np.zeros_like(label_list, dtype=np.float64)
-    label_size = np.zeros_like(label_list, dtype=np.int)
-    cdist_map = np.nan_to_num(cdist(data, data, metric=metric))
-
-    for i, label in enumerate(label_list):
-        vert_list = np.array(np.where(labels == label))[0]
-        label_size[i] = vert_list.shape[0]
-        cdist_map_label = cdist_map[:, vert_list][vert_list, :]
-
-        cdist_list[i] = np.mean(cdist_map_label[np.triu_indices_from(cdist_map_label, k=1)])
+    stats = _label_dist_sums(data, labels, metric)
+    label_list, label_size = stats[0], stats[-1]
+    pair_number = label_size * (label_size - 1) / 2.0
+    if stats[1] is not None:
+        _, label_sum, label_square, label_valid, _ = stats
+        sum_norm = np.sum(label_sum ** 2, axis=1)
+        if metric == 'sqeuclidean':
+            cdist_sum = label_size * label_square - sum_norm
+        else:
+            cdist_sum = label_valid * (label_valid - 1) / 2.0 - (sum_norm - label_square) / 2
+    else:
+        labels = np.reshape(labels, (-1))
+        cdist_sum = np.zeros(label_list.shape[0], dtype=np.float64)
+        for i, vert_list in enumerate(np.split(np.argsort(labels, kind='stable'), np.cumsum(label_size)[:-1])):
+            # distance of vertex with itself is 0, so sum of all pairs is twice of the upper triangle.
+            cdist_sum[i] = _cdist_sum(data[vert_list], data[vert_list], metric, chunk_size) / 2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cdist_list = cdist_sum / pair_number
     if label_size_count:
         return np.sum(label_size * cdist_list) / np.sum(label_size)
     return np.mean(cdist_list)
@@ -272,13 +318,7 @@ def cdist_mean(data, labels, metric='euclidean', coef=True, doing_zscore=False):
 
     # here we use unique labels for loop instead of max label number, to avoid error
     # caused by discontinuity labels, which may lead to nan in result.
-    label_list = np.unique(labels)
-    label_number = np.shape(label_list)[0]
-    time_point = np.shape(data)[-1]
-    data_mean = np.zeros((label_number, time_point), dtype=np.float64)
-    for i, label in enumerate(label_list):
-        data_vertices = data[np.where(labels == label)]
-        data_mean[i] = np.mean(data_vertices, axis=0)
+    label_list, data_mean = segment_mean(data, labels)
 
     cdist_map_label = np.nan_to_num(cdist(data_mean, data_mean, metric=metric))
     if coef:
@@ -311,13 +351,7 @@ def mean_data_cdist_max(data, labels, metric='euclidean', coef=True, doing_zscor
 
     # here we use unique labels for loop instead of max label number, to avoid error
     # caused by discontinuity labels, which may lead to nan in result.
-    label_list = np.unique(labels)
-    label_number = np.shape(label_list)[0]
-    time_point = np.shape(data)[-1]
-    data_mean = np.zeros((label_number, time_point), dtype=np.float64)
-    for i, label in enumerate(label_list):
-        data_vertices = data[np.where(labels == label)]
-        data_mean[i] = np.mean(data_vertices, axis=0)
+    label_list, data_mean = segment_mean(data, labels)
 
     cdist_map_label = np.nan_to_num(cdist(data_mean, data_mean, metric=metric))
     if coef:
@@ -327,7 +361,7 @@ def mean_data_cdist_max(data, labels, metric='euclidean', coef=True, doing_zscor
     return cdist_map_label
 
 
-def mean_data_cdist_adj(data, labels, label_faces, metric='euclidean', coef=True, integrate='mean', doing_zscore=False):
+def mean_data_cdist_adj(data, labels, label_graph, metric='euclidean', coef=True, integrate='mean', doing_zscore=False):
     """
     Calculate euclidean distance coefficient between label and its neighbors,
     based on its mean data.
@@ -336,7 +370,8 @@ def mean_data_cdist_adj(data, labels, label_faces, metric='euclidean', coef=True
     ----------
     data: time series, shape = [n_samples, n_features].
     labels: cluster labels, shape = [n_samples].
-    label_faces: Triangle meshes of labels. 2d array of shape (n_meshes, 3)
+    label_graph: adjacency of labels, (label_list, label_adjmatrix, neighbors) returned by
+        nsnt.utils.adj_tools.mk_label_graph(), result is calculated for labels in its label_list.
     metric: measurement, see help of scipy.spatial.distance.
     coef: whether return coef(float) or matrix(array), default is True.
     integrate: decide how to merge data of label and its neighbors, default is 'mean'.
@@ -358,23 +393,16 @@ def mean_data_cdist_adj(data, labels, label_faces, metric='euclidean', coef=True
 
     # here we use unique labels for loop instead of max label number, to avoid error
     # caused by discontinuity labels, which may lead to nan in result.
-    label_list = list(np.unique(labels))
-    label_number = np.shape(label_list)[0]
-    time_point = np.shape(data)[-1]
-    data_mean = np.zeros((label_number, time_point), dtype=np.float64)
-
-    for i, label in enumerate(label_list):
-        data_vertices = data[np.where(labels == label)]
-        data_mean[i] = np.mean(data_vertices, axis=0)
-
-    # get neighbor of labels
-    label_neighbor = faces_to_dict(label_faces)
-    cdist_map = np.zeros(label_number, dtype=np.float64)
-
-    for i, label in enumerate(label_list):
-        data_label = data_mean[[label_list.index(label)]]
-        data_neighbors = data_mean[[label_list.index(l) for l in label_neighbor[label]]]
-        print('shape of data_neighbors: {}'.format(data_neighbors.shape))
+    label_list, data_mean = segment_mean(data, labels)
+
+    # get neighbor of labels, and index of labels in graph in label_list.
+    graph_labels, _, (indptr, indices) = label_graph
+    graph_index = np.searchsorted(label_list, graph_labels)
+    cdist_map = np.zeros(graph_labels.shape[0], dtype=np.float64)
+
+    for i, index in enumerate(graph_index):
+        data_label = data_mean[[index]]
+        data_neighbors = data_mean[graph_index[indices[indptr[i]:indptr[i + 1]]]]
         cdist_map_neighbor = np.nan_to_num(cdist(data_label, data_neighbors, metric=metric))
 
         if integrate == 'max':
@@ -390,16 +418,18 @@ def mean_data_cdist_adj(data, labels, label_faces, metric='euclidean', coef=True
     return cdist_map
 
 
-def cdist_adj(data, labels, label_faces, metric='euclidean', integrate='mean', label_size_count=False, doing_zscore=False):
+def cdist_adj(data, labels, label_graph, metric='euclidean', integrate='mean', label_size_count=False,
+              doing_zscore=False, chunk_size=1024):
     """
     Calculate euclidean distance coefficient between label and its neighbors,
-    based on its mean data.
+    based on distances between their vertices.
 
     Parameters
     ----------
     data: time series, shape = [n_samples, n_features].
     labels: cluster labels, shape = [n_samples].
-    label_faces: Triangle meshes of labels. 2d array of shape (n_meshes, 3)
+    label_graph: adjacency of labels, (label_list, label_adjmatrix, neighbors) returned by
+        nsnt.utils.adj_tools.mk_label_graph(), result is calculated for labels in its label_list.
     metric: measurement, see help of scipy.spatial.distance.
     integrate: decide how to merge data of label and its neighbors, default is 'mean'.
         Options: 'max': keep the max metric as the result.
@@ -407,55 +437,121 @@ def cdist_adj(data, labels, label_faces, metric='euclidean', integrate='mean', l
             'min': keep the min metric as the result.
     label_size_count: whether balance size of label or not.
     doing_zscore: whether doing zscore to data or not.
+    chunk_size: number of vertices whose distances are calculated together,
+        used by metrics other than 'sqeuclidean' and 'correlation', default is 1024.
 
     Returns
     -------
     cdist_coef_label: float, reflects mean dissimilarity, based on metric.
-    cdist_map_label: matrix, reflects dissimilarity of all label pair, based on metric.
+
+    Notes
+    -----
+    1. dissimilarity of a label and its neighbor is mean distance of all pairs of their vertices,
+       only pairs of adjacent labels are calculated, and for 'sqeuclidean' and 'correlation'
+       they are got from sums of every label, see _label_dist_sums().
+    2. labels that have no neighbor are not counted.
     """
     if doing_zscore:
         print('Doing zscore to data.')
-        np.nan_to_num(zscore(data, axis=1))
+        data = np.nan_to_num(zscore(data, axis=1))
 
     assert integrate in ['min', 'max', 'mean'], "integrate could only be one of ['min', 'max', 'mean']."
 
-    # here we use unique labels for loop instead of max label number, to avoid error
-    # caused by discontinuity labels, which may lead to nan in result.
-    label_list = list(np.unique(labels))
-    label_number = np.shape(label_list)[0]
-    label_size = np.zeros_like(label_list, dtype=np.int)
-
-    # get neighbor of labels
-    label_neighbor = faces_to_dict(label_faces)
-    cdist_map = np.zeros(label_number, dtype=np.float64)
-
-    for i, label in enumerate(label_list):
-        vert_list = np.array(np.where(labels == label))[0]
-        label_size[i] = vert_list.shape[0]
-
-        data_label = data[[label_list.index(label)]]
-        print('shape of data_label: {}'.format(data_label.shape))
-        cdist_neighbor = []
-        for neighbor in label_neighbor[label]:
-            data_neighbor = data[np.where(labels == neighbor)[0]]
-            print('shape of data_neighbor: {}'.format(data_neighbor.shape))
-            cdist_map_neighbor = np.nan_to_num(cdist(data_label, data_neighbor, metric=metric))
-
-            # TODO change np.mean(data) to np.mean(data**2)
-            cdist_neighbor.append(np.mean(cdist_map_neighbor))
-        if integrate == 'max':
-            cdist_map[i] = np.max(cdist_neighbor)
-        elif integrate == 'min':
-            cdist_map[i] = np.min(cdist_neighbor)
+    # get neighbor of labels, and index of labels in graph in label_list.
+    graph_labels, _, (indptr, indices) = label_graph
+    stats = _label_dist_sums(data, labels, metric)
+    label_list, label_size = stats[0], stats[-1]
+    graph_index = np.searchsorted(label_list, graph_labels)
+    rows = graph_index[np.repeat(np.arange(graph_labels.shape[0]), np.diff(indptr))]
+    columns = graph_index[indices]
+
+    pair_size = label_size[rows] * label_size[columns].astype(np.float64)
+    if stats[1] is not None:
+        _, label_sum, label_square, label_valid, _ = stats
+        cross = np.sum(label_sum[rows] * label_sum[columns], axis=1)
+        if metric == 'sqeuclidean':
+            cdist_sum = label_size[columns] * label_square[rows] + label_size[rows] * label_square[columns] - 2 * cross
         else:
-            cdist_map[i] = np.mean(cdist_neighbor)
+            cdist_sum = label_valid[rows] * label_valid[columns].astype(np.float64) - cross
+    else:
+        labels = np.reshape(labels, (-1))
+        vert_lists = np.split(np.argsort(labels, kind='stable'), np.cumsum(label_size)[:-1])
+        # distance is symmetric, so every pair of adjacent labels is calculated once (a < b) and mirrored.
+        n_labels = label_list.shape[0]
+        upper = rows < columns
+        upper_key = rows[upper] * n_labels + columns[upper]
+        order = np.argsort(upper_key)
+        upper_sum = np.array([_cdist_sum(data[vert_lists[r]], data[vert_lists[c]], metric, chunk_size)
+                              for r, c in zip(rows[upper][order], columns[upper][order])], dtype=np.float64)
+        pair_key = np.minimum(rows, columns) * n_labels + np.maximum(rows, columns)
+        cdist_sum = upper_sum[np.searchsorted(upper_key[order], pair_key)]
+    cdist_neighbor = cdist_sum / pair_size
+
+    # integrate neighbors of every label that has neighbors.
+    has_neighbor = np.diff(indptr) > 0
+    starts = indptr[:-1][has_neighbor]
+    if integrate == 'max':
+        cdist_map = np.maximum.reduceat(cdist_neighbor, starts)
+    elif integrate == 'min':
+        cdist_map = np.minimum.reduceat(cdist_neighbor, starts)
+    else:
+        cdist_map = np.add.reduceat(cdist_neighbor, starts) / np.diff(indptr)[has_neighbor]
 
     if label_size_count:
-        return np.sum(label_size * cdist_map) / np.sum(label_size)
+        size = label_size[graph_index[has_neighbor]]
+        return np.sum(size * cdist_map) / np.sum(size)
     return np.mean(cdist_map)
 
 
-def silhouette_coef(data, labels, mask=None):
+def _label_dist_sums(data, labels, metric):
+    """
+    Get sums of every label, used to calculate sum of distances between vertices by expansion.
+
+    For 'sqeuclidean', sum of |x - y|^2 over pairs of label a and label b equals to
+        n_b * square_a + n_a * square_b - 2 * sum_a . sum_b
+    For 'correlation', rows are normalized to z (centered, unit norm), then sum of 1 - r over pairs equals to
+        v_a * v_b - sum_a . sum_b
+    where v is number of rows that have nonzero variance, as cdist(..., 'correlation') gives nan for pairs
+    with a zero variance row, which is counted as 0 after np.nan_to_num().
+    Pairs inside a label are got by removing the diagonal (square) and halving.
+
+    Returns
+    -------
+    label_list: sorted unique labels, shape = [n_labels].
+    label_sum: sum of (normalized) data in every label, shape = [n_labels, n_features],
+        None if metric could not be expanded.
+    label_square: sum of squared norm of (normalized) data in every label, shape = [n_labels],
+        None if metric could not be expanded.
+    label_valid: number of vertices that have nonzero variance in every label, shape = [n_labels],
+        None if metric could not be expanded.
+    label_size: number of vertices in every label, shape = [n_labels].
+    """
+    if metric not in ('sqeuclidean', 'correlation'):
+        label_list, label_size = np.unique(labels, return_counts=True)
+        return label_list, None, None, None, label_size
+
+    if metric == 'correlation':
+        data = normalize_rows(data)
+    square = np.sum(np.asarray(data, dtype=np.float64) ** 2, axis=1)
+    label_list, label_sum, label_size = segment_sum(data, labels)
+    _, label_square, _ = segment_sum(square, labels)
+    _, label_valid, _ = segment_sum((square > 0).astype(np.float64), labels)
+    return label_list, label_sum, label_square, label_valid, label_size
+
+
+def _cdist_sum(data1, data2, metric, chunk_size):
+    """Sum of distances between all rows of data1 and data2, rows of data1 are calculated in chunks."""
+    total = 0.0
+    for start in range(0, data1.shape[0], chunk_size):
+        total += np.sum(np.nan_to_num(cdist(data1[start:start + chunk_size], data2, metric=metric)))
+    return total
+
+
+SILHOUETTE_MODES = ('full', 'chunked', 'sampled', 'centroid')
+
+
+def silhouette_coef(data, labels, mask=None, mode='full', metric='euclidean', sample_size=10000, alpha=0.05,
+                    working_memory=None, random_state=None):
     """
     Calculate silhouette coefficient of the inputs.
 
@@ -464,17 +560,119 @@ def silhouette_coef(data, labels, mask=None):
     data: time series, shape = [n_samples, n_features].
     labels: cluster labels, shape = [n_samples].
     mask: binary array, 1 for region of interest and 0 for others, shape=(n_vertices,).
+    mode: how to calculate silhouette, one of ['full', 'chunked', 'sampled', 'centroid'], default is 'full'.
+        Options: 'full': sklearn.metrics.silhouette_score on all vertices, needs O(n_samples^2) memory.
+            'chunked': exact silhouette, distances are calculated in chunks with bounded memory.
+            'sampled': silhouette of vertices sampled from every label in proportion to its size,
+                a confidence interval of the estimate is returned too.
+            'centroid': simplified silhouette, distances to centroids of labels are used
+                instead of mean distances to vertices of labels, costs O(n_samples * n_labels).
+    metric: measurement, see help of sklearn.metrics.pairwise_distances, default is 'euclidean'.
+    sample_size: number of vertices sampled in 'sampled' mode, default is 10000.
+    alpha: confidence interval in 'sampled' mode is (1 - alpha), default is 0.05.
+    working_memory: memory(MB) used by a chunk of distances, default is None, means
+        the working_memory of sklearn config.
+    random_state: seed of random number generator used in 'sampled' mode, default is None.
 
     Returns
     -------
     silhouette coefficient
+    confidence_interval: (lower, upper) bound of silhouette coefficient, only returned in 'sampled' mode.
+
+    Notes
+    -----
+    1. as in sklearn, silhouette of vertex in label that has only one vertex is 0,
+       except in 'centroid' mode.
     """
     from sklearn.metrics.cluster import silhouette_score
 
+    assert mode in SILHOUETTE_MODES, 'mode could only be one of {}.'.format(SILHOUETTE_MODES)
+    mask = as_vertex_mask(mask)
     data = apply_1d_mask(data, mask)
     labels = apply_1d_mask(labels, mask)
 
-    return silhouette_score(data, labels)
+    if mode == 'full':
+        return silhouette_score(data, labels, metric=metric)
+
+    label_list, label_index, label_size = np.unique(labels, return_inverse=True, return_counts=True)
+    assert 1 < label_list.shape[0] < np.shape(labels)[0], \
+        'number of labels should be in [2, n_samples - 1], got {}.'.format(label_list.shape[0])
+    if mode == 'centroid':
+        _, centroids = segment_mean(data, labels)
+        return np.mean(_silhouette_values(data, label_index, centroids, metric=metric, working_memory=working_memory))
+    if mode == 'chunked':
+        return np.mean(_silhouette_values(data, label_index, data, label_size, metric=metric,
+                                          working_memory=working_memory))
+
+    # sample every label in proportion to its size, at least 2 vertices(if any) in a label.
+    rng = np.random.RandomState(random_state)
+    sample_number = np.minimum(label_size, np.maximum(2, np.round(sample_size * label_size / float(label_size.sum()))))
+    sample_number = sample_number.astype(int)
+    label_verts = np.split(np.argsort(label_index, kind='stable'), np.cumsum(label_size)[:-1])
+    rows = np.concatenate([rng.choice(verts, number, replace=False)
+                           for verts, number in zip(label_verts, sample_number)])
+    values = _silhouette_values(data, label_index, data, label_size, rows=rows, metric=metric,
+                                working_memory=working_memory)
+
+    # stratified estimate, its variance is corrected by the finite population of every label.
+    _, _, sample_mean, sample_var, _ = segment_stats(values, label_index[rows])
+    weight = label_size / float(label_size.sum())
+    sample_var = sample_var * sample_number / np.maximum(sample_number - 1, 1)
+    score = np.sum(weight * sample_mean)
+    std_error = np.sqrt(np.sum(weight ** 2 * (1 - sample_number / label_size.astype(float)) * sample_var / sample_number))
+    z = norm.ppf(1 - alpha / 2.0)
+    return score, (score - z * std_error, score + z * std_error)
+
+
+def _silhouette_values(data, label_index, targets, label_size=None, rows=None, metric='euclidean',
+                       working_memory=None):
+    """
+    Calculate silhouette of vertices, distances are calculated in chunks of rows.
+
+    Parameters
+    ----------
+    data: time series, shape = [n_samples, n_features].
+    label_index: index of label of every vertex, shape = [n_samples].
+    targets: data of all vertices, or centroids of labels if label_size is None.
+    label_size: number of vertices in every label, shape = [n_labels], default is None,
+        means targets are centroids and simplified silhouette is calculated.
+    rows: index of vertices whose silhouette is calculated, default is None, means all vertices.
+
+    Returns
+    -------
+    values: silhouette of vertices in rows, shape = [n_rows].
+    """
+    from sklearn.metrics import pairwise_distances_chunked
+
+    if rows is None:
+        rows = np.arange(data.shape[0])
+    if label_size is not None:
+        n_samples = label_index.shape[0]
+        onehot = sparse.csr_matrix((np.ones(n_samples), (label_index, np.arange(n_samples))),
+                                   shape=(label_size.shape[0], n_samples))
+
+    values = np.zeros(rows.shape[0], dtype=np.float64)
+    start = 0
+    for chunk in pairwise_distances_chunked(data[rows], targets, metric=metric, working_memory=working_memory):
+        own = label_index[rows[start:start + chunk.shape[0]]]
+        index = np.arange(chunk.shape[0])
+        if label_size is not None:
+            # mean distance to vertices of every label, vertex itself is not counted in its own label.
+            label_dist = onehot.dot(chunk.T).T
+            a = label_dist[index, own] / np.maximum(label_size[own] - 1, 1)
+            label_dist /= label_size
+        else:
+            label_dist = chunk
+            a = label_dist[index, own]
+        label_dist[index, own] = np.inf
+        b = np.min(label_dist, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk_values = np.nan_to_num((b - a) / np.maximum(a, b))
+        if label_size is not None:
+            chunk_values[label_size[own] == 1] = 0
+        values[start:start + chunk.shape[0]] = chunk_values
+        start += chunk.shape[0]
+    return values
 
 
 def nonconnected_score(labels, faces):
@@ -500,7 +698,7 @@ def nonconnected_score(labels, faces):
     return len(nonc_list) / len(np.unique(labels))
 
 
-def loyalty_map(vote_matrix, labels):
+def loyalty_map(vote_matrix, labels, return_matrix=False):
     """
     Calculate loyalty of every vertex to its labels through vote matrix.
 
@@ -508,18 +706,266 @@ def loyalty_map(vote_matrix, labels):
     ----------
     vote_matrix: created by parcellate the same data repeatedly,
         and count the times that two vertices in the same label,
-        shape=(n_vertices, n_vertices).
+        array, sparse matrix or VoteMatrix, shape=(n_vertices, n_vertices).
     labels: cluster labels, shape=(n_vertices,).
+    return_matrix: whether return loyalty of every vertex to every label or not, default is False.
 
     Return
     ------
-    loyalty: loyalty of every vertex belong to its label.
+    loyalty: loyalty of every vertex belong to its label, mean vote of the vertex with other vertices
+        in its label, nan for vertex in label that has only one vertex, shape=(n_vertices,).
+    label_list: sorted unique labels, shape=(n_labels,), only returned if return_matrix is True.
+    loyalty_matrix: sparse matrix(CSR), mean vote of every vertex with vertices in every label
+        (the vertex itself is not counted), shape=(n_vertices, n_labels), only returned if return_matrix is True.
+
+    Notes
+    -----
+    1. vertices could be reassigned to their most loyal label by
+       label_list[np.asarray(loyalty_matrix.argmax(axis=1)).ravel()].
     """
-    n_vertices = np.shape(labels)[0]
-    loyalty = np.zeros_like(labels)
+    if isinstance(vote_matrix, VoteMatrix):
+        vote_matrix = vote_matrix.matrix
+    labels = np.reshape(labels, (-1))
+    n_vertices = labels.shape[0]
+    votes = sparse.csr_matrix(vote_matrix, dtype=np.float64)
+    label_list, onehot = label_onehot(labels)
+    label_index = np.searchsorted(label_list, labels)
+    label_size = np.diff(onehot.indptr)
+
+    # sum of votes of every vertex with vertices in every label, remove vote of the vertex with itself.
+    self_votes = sparse.csr_matrix((votes.diagonal(), (np.arange(n_vertices), label_index)),
+                                   shape=(n_vertices, label_list.shape[0]))
+    label_votes = sparse.csr_matrix(votes.dot(onehot.T) - self_votes)
+    own_votes = np.asarray(label_votes[np.arange(n_vertices), label_index]).ravel()
+    own_size = label_size[label_index] - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        loyalty = np.where(own_size > 0, own_votes / np.maximum(own_size, 1), np.nan)
+    if not return_matrix:
+        return loyalty
+
+    loyalty_matrix = sparse.csr_matrix(label_votes.multiply(1.0 / label_size[np.newaxis, :]))
+    # the vertex itself is not in the size of its own label.
+    loyalty_matrix = loyalty_matrix + sparse.csr_matrix(
+        (np.nan_to_num(loyalty) - own_votes / label_size[label_index], (np.arange(n_vertices), label_index)),
+        shape=loyalty_matrix.shape)
+    return loyalty, label_list, loyalty_matrix
+
+
+class _LabelContext(object):
+    """
+    Intermediates of a label image shared by metrics in ParcellationEvaluator,
+        every intermediate is calculated when it's first used.
+    """
+    def __init__(self, evaluator, labels):
+        self.evaluator = evaluator
+        self.labels = np.reshape(labels, (-1))
+        self._cache = {}
+
+    def get(self, name):
+        if name not in self._cache:
+            self._cache[name] = getattr(self, '_' + name)()
+        return self._cache[name]
+
+    def _label_sum(self):
+        return segment_sum(self.evaluator.data, self.labels)
+
+    def _label_mean(self):
+        _, label_sum, label_size = self.get('label_sum')
+        return label_sum / label_size[:, np.newaxis]
+
+    def _label_cdist(self):
+        label_mean = self.get('label_mean')
+        return np.nan_to_num(cdist(label_mean, label_mean, metric=self.evaluator.metric))
+
+    def _label_adjmatrix(self):
+        _, label_adjmatrix, _ = mk_label_graph(self.labels, adjm=self.evaluator.adjmatrix)
+        return label_adjmatrix
+
+    def _homogeneity(self):
+        return _homogeneity(None, self.labels, norm_data=self.evaluator.norm_data)
+
+    def _components(self):
+        return label_components(self.labels, adjm=self.evaluator.adjmatrix)
+
+
+def _eval_homogeneity(ctx):
+    return np.mean(ctx.get('homogeneity')[1])
+
+
+def _eval_homogeneity_size(ctx):
+    _, homo_list, _, label_size = ctx.get('homogeneity')
+    return np.sum(label_size * homo_list) / np.sum(label_size)
+
+
+def _eval_cdist_mean(ctx):
+    cdist_map_label = ctx.get('label_cdist')
+    return np.mean(cdist_map_label[np.triu_indices_from(cdist_map_label, k=1)])
+
+
+def _eval_cdist_max(ctx):
+    return np.mean(np.max(ctx.get('label_cdist'), axis=0))
 
-    for vertex in range(n_vertices):
-        label_vertices = np.where(labels == labels[vertex])
-        label_vertices = np.delete(label_vertices, np.where(label_vertices == vertex))
-        loyalty[vertex] = np.mean(vote_matrix[vertex][label_vertices])
-    return loyalty
+
+def _eval_cdist_adj(ctx):
+    label_adjmatrix = ctx.get('label_adjmatrix')
+    neighbor_number = np.asarray(label_adjmatrix.sum(axis=1)).ravel()
+    cdist_neighbor = np.asarray(label_adjmatrix.multiply(ctx.get('label_cdist')).sum(axis=1)).ravel()
+    return np.mean(cdist_neighbor[neighbor_number > 0] / neighbor_number[neighbor_number > 0])
+
+
+def _eval_nonconnected(ctx):
+    _, component_labels = ctx.get('components')
+    label_list, component_number = np.unique(component_labels, return_counts=True)
+    nonc_number = np.count_nonzero((component_number > 1) & (label_list < np.max(ctx.labels)))
+    return nonc_number / float(label_list.shape[0])
+
+
+def _eval_silhouette(ctx):
+    return silhouette_coef(ctx.evaluator.data, ctx.labels, mode='chunked')
+
+
+def _eval_dice(ctx):
+    return dice_coef(ctx.labels, ctx.evaluator.reference)
+
+
+def _eval_ari(ctx):
+    return ari(ctx.labels, ctx.evaluator.reference)
+
+
+def _eval_ami(ctx):
+    return ami(ctx.labels, ctx.evaluator.reference)
+
+
+def _eval_label_number(ctx):
+    return ctx.get('label_sum')[0].shape[0]
+
+
+# metrics supported by ParcellationEvaluator, and whether faces or reference is needed.
+EVAL_METRICS = {
+    'label_number': (_eval_label_number, None),
+    'homogeneity': (_eval_homogeneity, None),
+    'homogeneity_size': (_eval_homogeneity_size, None),
+    'cdist_mean': (_eval_cdist_mean, None),
+    'cdist_max': (_eval_cdist_max, None),
+    'cdist_adj': (_eval_cdist_adj, 'faces'),
+    'nonconnected': (_eval_nonconnected, 'faces'),
+    'silhouette': (_eval_silhouette, None),
+    'dice': (_eval_dice, 'reference'),
+    'ari': (_eval_ari, 'reference'),
+    'ami': (_eval_ami, 'reference'),
+}
+
+def _run_eval(evaluator, task):
+    name, labels, metrics = task
+    return name, evaluator.evaluate(labels, metrics)
+
+
+class ParcellationEvaluator(object):
+    """
+    Evaluate many label images against the same data.
+
+    Data is z-scored(if needed) and normalized once, and adjacency of vertexes is built
+        once, intermediates of a label image(label means, label adjacency, etc.) are calculated
+        once and shared by all metrics.
+
+    Parameters
+    ----------
+    data: time series, shape = [n_samples, n_features].
+    faces: faces of vertexes, needed by metrics 'cdist_adj' and 'nonconnected', default is None.
+    reference: reference labels, needed by metrics 'dice', 'ari' and 'ami', default is None.
+    metric: measurement used in cdist metrics, see help of scipy.spatial.distance, default is 'euclidean'.
+    doing_zscore: whether doing zscore to data or not.
+
+    Notes
+    -----
+    1. available metrics, see EVAL_METRICS:
+       'label_number', 'homogeneity', 'homogeneity_size'(homogeneity_coef with label_size_count),
+       'cdist_mean'(cdist_mean), 'cdist_max'(mean_data_cdist_max), 'cdist_adj'(mean_data_cdist_adj),
+       'nonconnected'(nonconnected_score), 'silhouette'(silhouette_coef),
+       'dice'(dice_coef), 'ari', 'ami'.
+    """
+    def __init__(self, data, faces=None, reference=None, metric='euclidean', doing_zscore=False):
+        if doing_zscore:
+            print('Doing zscore to data.')
+            data = np.nan_to_num(zscore(data, axis=1))
+        self.data = np.asarray(data, dtype=np.float64)
+        self.norm_data = normalize_rows(self.data)
+        self.adjmatrix = None
+        if faces is not None:
+            self.adjmatrix = faces_to_adjmatrix(faces, n_vertexes=self.data.shape[0])
+        self.reference = reference
+        self.metric = metric
+
+    def _check_metrics(self, metrics):
+        for name in metrics:
+            if name not in EVAL_METRICS:
+                raise ValueError('Unknown metric {0}, should be one of {1}.'.format(name, sorted(EVAL_METRICS)))
+            need = EVAL_METRICS[name][1]
+            if need == 'faces' and self.adjmatrix is None:
+                raise ValueError('Metric {} needs faces.'.format(name))
+            if need == 'reference' and self.reference is None:
+                raise ValueError('Metric {} needs reference labels.'.format(name))
+
+    def evaluate(self, labels, metrics=('homogeneity', 'cdist_mean')):
+        """
+        Evaluate a label image.
+
+        Parameters
+        ----------
+        labels: cluster labels, shape = [n_samples].
+        metrics: names of metrics, default is ('homogeneity', 'cdist_mean').
+
+        Returns
+        -------
+        scores: dict of metric name and its score.
+        """
+        self._check_metrics(metrics)
+        ctx = _LabelContext(self, labels)
+        return dict((name, EVAL_METRICS[name][0](ctx)) for name in metrics)
+
+    def run(self, label_images, names=None, metrics=('homogeneity', 'cdist_mean'), n_jobs=1):
+        """
+        Evaluate label images, label images are distributed across a process pool.
+
+        Parameters
+        ----------
+        label_images: sequence of label images, every label image has shape = [n_samples].
+        names: names of label images, default is None, means use index of label images.
+        metrics: names of metrics, default is ('homogeneity', 'cdist_mean').
+        n_jobs: number of worker processes, default is 1.
+
+        Returns
+        -------
+        report: structured array, with field 'name' and a field of every metric,
+            shape = (n_label_images, ), see save_report().
+        """
+        self._check_metrics(metrics)
+        if names is None:
+            names = [str(i) for i in range(len(label_images))]
+        tasks = [(name, labels, metrics) for name, labels in zip(names, label_images)]
+
+        results = list(shared_map(_run_eval, tasks, shared=self, n_jobs=n_jobs))
+
+        name_length = max([len(str(name)) for name in names] + [1])
+        dtype = [('name', 'U{}'.format(name_length))] + [(name, np.float64) for name in metrics]
+        report = np.zeros(len(results), dtype=dtype)
+        for i, (name, scores) in enumerate(results):
+            report[i] = tuple([name] + [scores[metric] for metric in metrics])
+        return report
+
+
+def save_report(report, filepath):
+    """
+    Save report of ParcellationEvaluator.run() as csv file.
+
+    Parameters
+    ----------
+    report: structured array, returned by ParcellationEvaluator.run().
+    filepath: path of csv file.
+    """
+    with open(filepath, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(report.dtype.names)
+        for row in report:
+            writer.writerow(row.tolist())
+    print("Saving %s" % filepath)
@@ -5,10 +5,116 @@ the input file(*.mgh) is converted from *.nii.gz file, in order to display by py
 isfc: Inter-subject functional correlation.
 isc: Inter-subject correlation.
 fc: Functional correlation.
+isc_loo, isfc_loo: leave-one-out ISC and ISFC across a group of subjects.
+isc_pairwise: ISC of every subject pair.
+isc_sliding, isfc_sliding: dynamic ISC and ISFC with a sliding window.
 """
 import numpy as np
 from scipy.stats import zscore
-from scipy.spatial.distance import cdist
+
+
+def normalize_rows(data, dtype=np.float64):
+    """
+    Center every row of data and scale it to unit norm, so that the dot product of
+    two normalized rows equals to their pearson correlation.
+
+    Parameters
+    ----------
+    data: time series, shape = [n_samples, n_features].
+    dtype: dtype of the result, np.float32 or np.float64, default is np.float64.
+
+    Returns
+    -------
+    norm_data: normalized data, shape = [n_samples, n_features].
+
+    Notes
+    -----
+    1. rows with zero variance are set to 0, so their correlation with others is 0.
+    """
+    norm_data = np.array(data, dtype=dtype)
+    norm_data -= np.mean(norm_data, axis=1, keepdims=True)
+    row_norm = np.sqrt(np.sum(norm_data ** 2, axis=1, keepdims=True))
+    row_norm[row_norm == 0] = np.inf  # zero variance rows will be divided to 0.
+    norm_data /= row_norm
+    return norm_data
+
+
+def isfc_tiles(data1, data2=None, block_size=2048, dtype=np.float32):
+    """
+    Cal functional connectivity between data1 and data2 tile by tile.
+
+    Every input is normalized only once, then correlation of a tile is calculated
+        as a matrix product of normalized rows.
+    If data2 is None, the functional connectivity of data1 is calculated, and only
+        tiles in the upper triangle are computed, tiles in the lower triangle are
+        yielded as transpose of them.
+
+    Parameters
+    ----------
+    data1: used to calculate functional connectivity, shape = [n_samples1, n_features].
+    data2: used to calculate functional connectivity, shape = [n_samples2, n_features].
+        Default is None, means using data1.
+    block_size: max number of rows(and columns) in a tile, default is 2048.
+    dtype: np.float32 or np.float64, dtype of the calculation, default is np.float32.
+
+    Yields
+    ------
+    key: tuple of (row_slice, column_slice), position of tile in the full result.
+    tile: functional connectivity of the tile, shape = [n_rows, n_columns].
+    """
+    norm_data1 = normalize_rows(data1, dtype=dtype)
+    symmetric = data2 is None
+    norm_data2 = norm_data1 if symmetric else normalize_rows(data2, dtype=dtype)
+    assert norm_data1.shape[1] == norm_data2.shape[1], \
+        'n_features should be the same in data1 and data2, got {0}, {1}'.format(norm_data1.shape,
+                                                                               norm_data2.shape)
+
+    n_samples1, n_samples2 = norm_data1.shape[0], norm_data2.shape[0]
+    for i in range(0, n_samples1, block_size):
+        rows = slice(i, min(i + block_size, n_samples1))
+        start = i if symmetric else 0
+        for j in range(start, n_samples2, block_size):
+            columns = slice(j, min(j + block_size, n_samples2))
+            tile = np.dot(norm_data1[rows], norm_data2[columns].T)
+            yield (rows, columns), tile
+            if symmetric and j != i:
+                yield (columns, rows), tile.T
+
+
+def isfc_blocked(data1, data2=None, out=None, block_size=2048, dtype=np.float32):
+    """
+    Cal functional connectivity between data1 and data2, and write the result to out tile by tile.
+
+    Parameters
+    ----------
+    data1: used to calculate functional connectivity, shape = [n_samples1, n_features].
+    data2: used to calculate functional connectivity, shape = [n_samples2, n_features].
+        Default is None, means calculate functional connectivity of data1.
+    out: sink of the result, anything that supports `out[row_slice, column_slice] = tile`,
+        like an array, np.memmap (see np.lib.format.open_memmap), or nsnt.iofunc.iofile.TileStore.
+        Default is None, means create an array in memory.
+    block_size: max number of rows(and columns) in a tile, default is 2048.
+    dtype: np.float32 or np.float64, dtype of the calculation, default is np.float32.
+
+    Returns
+    -------
+    out: functional connectivity map of data1 and data2, shape = [n_samples1, n_samples2].
+
+    Examples
+    --------
+    >>> out = np.lib.format.open_memmap('isfc.npy', mode='w+', dtype=np.float32, shape=(n1, n2))
+    >>> isfc_blocked(data1, data2, out=out)
+    """
+    if out is None:
+        n_samples1 = np.shape(data1)[0]
+        n_samples2 = n_samples1 if data2 is None else np.shape(data2)[0]
+        out = np.empty((n_samples1, n_samples2), dtype=dtype)
+
+    for key, tile in isfc_tiles(data1, data2, block_size=block_size, dtype=dtype):
+        out[key] = tile
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
 
 
 def isfc(data1, data2):
@@ -28,8 +134,10 @@ def isfc(data1, data2):
     -----
     1. data1 and data2 should both be 2-dimensional.
     2. n_features should be the same in data1 and data2.
+    3. correlation of rows with zero variance is 0.
+    4. for large data, see isfc_blocked().
     """
-    return 1 - cdist(data1, data2, metric='correlation')
+    return isfc_blocked(data1, data2, dtype=np.float64)
 
 
 def isc(data1, data2):
@@ -76,4 +184,230 @@ def wsfc(data):
     -----
     1. data should be 2-dimensional.
     """
-    return isfc(data, data)
+    return isfc_blocked(data, dtype=np.float64)
+
+
+def _loo_pairs(data):
+    """
+    Yield every subject in data and the sum of the other subjects.
+
+    The group sum is calculated only once, and the sum of the other subjects is
+        got by subtracting the subject from it, since correlation is not affected
+        by scale, the sum works the same as the mean of the other subjects.
+    """
+    assert np.ndim(data) == 3 and np.shape(data)[0] > 1, \
+        'data should be 3-d array with at least 2 subjects, got shape {}'.format(np.shape(data))
+
+    group_sum = np.sum(data, axis=0, dtype=np.float64)
+    for i in range(np.shape(data)[0]):
+        subject = np.asarray(data[i], dtype=np.float64)
+        yield i, subject, group_sum - subject
+
+
+def isc_loo(data, dtype=np.float64):
+    """
+    Cal leave-one-out ISC, every subject is compared with the mean of the other subjects.
+
+    Parameters
+    ----------
+    data: time series of subjects, shape = [n_subjects, n_samples, n_features].
+    dtype: np.float32 or np.float64, dtype of the calculation, default is np.float64.
+
+    Returns
+    -------
+    isc: point-to-point ISC map of every subject, shape = [n_subjects, n_samples].
+    """
+    result = np.empty(np.shape(data)[:2], dtype=dtype)
+    for i, subject, others in _loo_pairs(data):
+        result[i] = np.sum(normalize_rows(subject, dtype) * normalize_rows(others, dtype), axis=1)
+    return result
+
+
+def isfc_loo(data, out=None, block_size=2048, dtype=np.float32):
+    """
+    Cal leave-one-out ISFC, every subject is compared with the mean of the other subjects.
+
+    Parameters
+    ----------
+    data: time series of subjects, shape = [n_subjects, n_samples, n_features].
+    out: sink of the result, shape = [n_subjects, n_samples, n_samples], `out[i]` is used as
+        the sink of subject i in isfc_blocked(), default is None, means create an array in memory.
+    block_size: max number of rows(and columns) in a tile, default is 2048.
+    dtype: np.float32 or np.float64, dtype of the calculation, default is np.float32.
+
+    Returns
+    -------
+    isfc: ISFC map of every subject, shape = [n_subjects, n_samples, n_samples].
+    """
+    if out is None:
+        n_subjects, n_samples = np.shape(data)[:2]
+        out = np.empty((n_subjects, n_samples, n_samples), dtype=dtype)
+    for i, subject, others in _loo_pairs(data):
+        isfc_blocked(subject, others, out=out[i], block_size=block_size, dtype=dtype)
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
+
+
+def isc_pairwise(data, dtype=np.float64):
+    """
+    Cal ISC of every subject pair vertex by vertex.
+
+    Every subject is normalized only once, then ISC of subject i with all the
+        subjects after it is calculated in one batch, so only pairs in the
+        upper triangle are calculated.
+
+    Parameters
+    ----------
+    data: time series of subjects, shape = [n_subjects, n_samples, n_features].
+    dtype: np.float32 or np.float64, dtype of the calculation, default is np.float64.
+
+    Returns
+    -------
+    isc: condensed ISC of subject pairs, shape = [n_pairs, n_samples],
+        n_pairs = n_subjects * (n_subjects - 1) / 2, the order of pairs is the same as
+        np.triu_indices(n_subjects, k=1) and scipy.spatial.distance.squareform.
+    """
+    assert np.ndim(data) == 3 and np.shape(data)[0] > 1, \
+        'data should be 3-d array with at least 2 subjects, got shape {}'.format(np.shape(data))
+
+    n_subjects, n_samples = np.shape(data)[:2]
+    norm_data = np.empty(np.shape(data), dtype=dtype)
+    for i in range(n_subjects):
+        norm_data[i] = normalize_rows(data[i], dtype)
+
+    result = np.empty((n_subjects * (n_subjects - 1) // 2, n_samples), dtype=dtype)
+    start = 0
+    for i in range(n_subjects - 1):
+        stop = start + n_subjects - 1 - i
+        result[start:stop] = np.einsum('vt,svt->sv', norm_data[i], norm_data[i + 1:])
+        start = stop
+    return result
+
+
+def _sliding_corr(data1, data2, window, step, pairwise):
+    """
+    Yield correlation of every sliding window, by updating running sums
+        (sum of x, y, x*y, x**2, y**2) as time points enter and leave the window.
+
+    If pairwise is True, x*y is calculated between all rows of data1 and data2 (ISFC),
+        otherwise, it's calculated row by row (ISC).
+    """
+    # center rows over the whole run first, to keep running sums small and precise.
+    x = np.asarray(data1, dtype=np.float64)
+    y = np.asarray(data2, dtype=np.float64)
+    assert x.ndim == 2 and y.ndim == 2 and x.shape[1] == y.shape[1], \
+        'data1 and data2 should be 2-d array with the same n_features, got {0}, {1}'.format(x.shape, y.shape)
+    assert 1 < window <= x.shape[1], 'window should be in range (1, n_features], got {}'.format(window)
+    x = x - np.mean(x, axis=1, keepdims=True)
+    y = y - np.mean(y, axis=1, keepdims=True)
+
+    def cross(a, b):
+        return np.dot(a, b.T) if pairwise else np.sum(a * b, axis=1)
+
+    def outer(a, b):
+        return np.outer(a, b) if pairwise else a * b
+
+    sum_x, sum_y = np.sum(x[:, :window], axis=1), np.sum(y[:, :window], axis=1)
+    sum_xx, sum_yy = np.sum(x[:, :window] ** 2, axis=1), np.sum(y[:, :window] ** 2, axis=1)
+    sum_xy = cross(x[:, :window], y[:, :window])
+
+    for start in range(x.shape[1] - window + 1):
+        if start > 0:
+            old, new = start - 1, start + window - 1
+            sum_x += x[:, new] - x[:, old]
+            sum_y += y[:, new] - y[:, old]
+            sum_xx += x[:, new] ** 2 - x[:, old] ** 2
+            sum_yy += y[:, new] ** 2 - y[:, old] ** 2
+            sum_xy += outer(x[:, new], y[:, new]) - outer(x[:, old], y[:, old])
+        if start % step:
+            continue
+
+        var_x = np.maximum(window * sum_xx - sum_x ** 2, 0)
+        var_y = np.maximum(window * sum_yy - sum_y ** 2, 0)
+        denom = np.sqrt(outer(var_x, var_y))
+        denom[denom == 0] = np.inf  # correlation of zero variance window is 0.
+        yield start, (window * sum_xy - outer(sum_x, sum_y)) / denom
+
+
+def isc_sliding_iter(data1, data2, window, step=1):
+    """
+    Cal dynamic ISC between data1 and data2 with a sliding window, yield window by window.
+
+    Parameters
+    ----------
+    data1: used to calculate functional connectivity, shape = [n_samples, n_features].
+    data2: used to calculate functional connectivity, shape = [n_samples, n_features].
+    window: number of time points in a window.
+    step: number of time points between starts of two windows, default is 1.
+
+    Yields
+    ------
+    start: the first time point of the window.
+    isc: ISC of the window, shape = [n_samples, ].
+    """
+    return _sliding_corr(data1, data2, window, step, pairwise=False)
+
+
+def isc_sliding(data1, data2, window, step=1):
+    """
+    Cal dynamic ISC between data1 and data2 with a sliding window.
+
+    Parameters
+    ----------
+    data1: used to calculate functional connectivity, shape = [n_samples, n_features].
+    data2: used to calculate functional connectivity, shape = [n_samples, n_features].
+    window: number of time points in a window.
+    step: number of time points between starts of two windows, default is 1.
+
+    Returns
+    -------
+    isc: time course of ISC, shape = [n_windows, n_samples],
+        n_windows = (n_features - window) // step + 1.
+    """
+    return np.array([corr for _, corr in isc_sliding_iter(data1, data2, window, step)])
+
+
+def isfc_sliding_iter(data1, data2, window, step=1):
+    """
+    Cal dynamic ISFC between data1 and data2 with a sliding window, yield window by window.
+
+    Parameters
+    ----------
+    data1: used to calculate functional connectivity, shape = [n_samples1, n_features].
+    data2: used to calculate functional connectivity, shape = [n_samples2, n_features].
+    window: number of time points in a window.
+    step: number of time points between starts of two windows, default is 1.
+
+    Yields
+    ------
+    start: the first time point of the window.
+    isfc: ISFC of the window, shape = [n_samples1, n_samples2].
+    """
+    return _sliding_corr(data1, data2, window, step, pairwise=True)
+
+
+def isfc_sliding(data1, data2, window, step=1, out=None):
+    """
+    Cal dynamic ISFC between data1 and data2 with a sliding window.
+
+    Parameters
+    ----------
+    data1: used to calculate functional connectivity, shape = [n_samples1, n_features].
+    data2: used to calculate functional connectivity, shape = [n_samples2, n_features].
+    window: number of time points in a window.
+    step: number of time points between starts of two windows, default is 1.
+    out: array(or np.memmap) to save the result, shape = [n_windows, n_samples1, n_samples2],
+        default is None, means create an array in memory.
+
+    Returns
+    -------
+    isfc: time course of ISFC, shape = [n_windows, n_samples1, n_samples2],
+        n_windows = (n_features - window) // step + 1.
+    """
+    if out is None:
+        n_windows = (np.shape(data1)[1] - window) // step + 1
+        out = np.empty((n_windows, np.shape(data1)[0], np.shape(data2)[0]))
+    for start, corr in isfc_sliding_iter(data1, data2, window, step):
+        out[start // step] = corr
+    return out
@@ -1,12 +1,11 @@
 import os
 from time import time
-from itertools import combinations
 
-import numpy as np
 import nibabel as nib
-from scipy.sparse import csc_matrix
 
 from nsnt.utils.adj_tools import SurfaceGeometry, split_connected_components
+from nsnt.utils.segment_tools import VoteMatrix
+from nsnt.utils.pool_tools import shared_map
 
 
 def load_data(data_root, file_name):
@@ -50,47 +49,118 @@ def get_filename(method_name, runid, parcel_num):
     return dataroot, filename1
 
 
-if __name__ == "__main__":
-    # sessid="/nfs/s1/data/gumpdata/project/sessid"
-    datadir = "/nfs/s1/studyforrest"
-    projectdir = '/nfs/t3/workingshop/baihaohao/studyforrest'
-    runidlist = ["001", "002", "003", "004", "005", "006", "007", "008"]
+def get_vote_paths(config, runid, method_name, parcel_num):
+    """
+    Get paths of repeated label images and the vote matrix of a sweep cell.
+
+    Parameters
+    ----------
+    config: sweep config, see run_vote_sweep().
+    runid: id of run.
+    method_name: name of clustering method.
+    parcel_num: number of parcels.
+
+    Returns
+    -------
+    label_paths: paths of repeated label images.
+    vote_path: path of vote matrix.
+    """
+    dataroot = os.path.join(config['projectdir'], runid, method_name, "repeated")
+    repeats = config.get('repeats', 100)
+    label_paths = [os.path.join(dataroot, "%s-res-%s-%i-by_vertex-%i.mgz" % (method_name, runid, parcel_num, times))
+                   for times in range(repeats)]
+    # vote matrix is saved by scipy.sparse.save_npz(), suffix differs from the dense np.savez() result.
+    resultname = "%s-res-%s-%i-by_vertex-overlap-sec%i.sparse.npz" % (method_name, runid, parcel_num, repeats)
+    return label_paths, os.path.join(dataroot, resultname)
+
+
+def _load_sweep_geometry(config):
+    """Load geometry once in every worker process, the on-disk cache is used if cache_dir is given."""
+    geometry = SurfaceGeometry(config.get('subj_id', 'fsaverage5'), config.get('hemi', 'lh'),
+                               config.get('surf', 'inflated'), subjects_dir=config.get('subjects_dir'),
+                               cache_dir=config.get('cache_dir'))
+    return {'faces': geometry.faces, 'adjmatrix': geometry.adjmatrix}
+
+
+def _run_vote_cell(geometry, task):
+    """
+    Create vote matrix of a sweep cell, skip it if vote matrix is newer than label images.
+
+    Returns
+    -------
+    cell: (runid, method_name, parcel_num).
+    status: 'done', 'skipped' or 'missing'(some label images are not found).
+    spend_time: seconds spent on the cell.
+    """
+    config, cell = task
+    t0 = time()
+    label_paths, vote_path = get_vote_paths(config, *cell)
+
+    missing = [path for path in label_paths if not os.path.exists(path)]
+    if missing:
+        print("Missing {0} label images of {1}, first: {2}".format(len(missing), cell, missing[0]))
+        return cell, 'missing', time() - t0
+    if os.path.exists(vote_path) and \
+            os.path.getmtime(vote_path) >= max(os.path.getmtime(path) for path in label_paths):
+        return cell, 'skipped', time() - t0
+
+    adjmatrix = geometry['adjmatrix']
+    result = VoteMatrix(adjmatrix.shape[0])
+    for label_path in label_paths:
+        labelimg1 = load_data(*os.path.split(label_path))
+        result.add(split_connected_components(labels=labelimg1, faces=geometry['faces'], adjm=adjmatrix))
+    result.save(vote_path)
+    return cell, 'done', time() - t0
+
+
+def run_vote_sweep(config, n_jobs=1):
+    """
+    Create vote matrices of all (runid, method_name, parcel_num) cells in config,
+        cells are run in a process pool, and cells that are up to date are skipped.
+
+    Parameters
+    ----------
+    config: dict of sweep config, keys:
+        projectdir: project directory, label images of a cell are in projectdir/runid/method_name/repeated.
+        runids: list of run id.
+        methods: list of clustering method name.
+        parcel_nums: list of parcel number.
+        repeats: number of repeated label images in a cell, optional, default is 100.
+        subj_id, hemi, surf, subjects_dir, cache_dir: used to load geometry, see SurfaceGeometry,
+            optional, default is ('fsaverage5', 'lh', 'inflated', None, None).
+    n_jobs: number of worker processes, default is 1.
+
+    Returns
+    -------
+    report: list of (cell, status, spend_time), see _run_vote_cell().
+    """
+    cells = [(runid, method_name, parcel_num) for runid in config['runids']
+             for method_name in config['methods'] for parcel_num in config['parcel_nums']]
+    tasks = [(config, cell) for cell in cells]
 
-    funcname = "audiovisual3T"
-    analysisname = "preproc.fs5.lh"
+    t0 = time()
+    report = []
+    results = shared_map(_run_vote_cell, tasks, shared=config, initializer=_load_sweep_geometry,
+                         n_jobs=n_jobs, ordered=False)
+    for cell, status, spend_time in results:
+        print("{0}: {1}, spend time: {2:f}".format(cell, status, spend_time))
+        report.append((cell, status, spend_time))
+    print("Total spend time: %f" % (time() - t0))
+    return report
 
-    faces = SurfaceGeometry('fsaverage5', 'lh', 'inflated').faces
 
-    t0 = time()
-    for runid in runidlist:
-
-        parcels_list = range(50, 300, 50)
-        # method_list = ["KMeans", "hier_clustering", "spectral_clustering", "geo"]
-        method_list = ["KMeans", "hier_clustering", "spectral_clustering"]
-
-        for method_name in method_list:
-            for parcel_num in parcels_list:
-                dataroot = os.path.join(projectdir, runid, method_name, "repeated")
-                result = np.zeros((10242, 10242))
-
-                for times in range(100):
-                    filename1 = "%s-res-%s-%i-by_vertex-%i.mgz" % (method_name, runid, parcel_num, times)
-                    print("Loading {}".format(filename1))
-                    labelimg1 = load_data(dataroot, filename1)
-
-                    labelimg2 = split_connected_components(labels=labelimg1, faces=faces)
-                    labels = np.unique(labelimg2)
-
-                    for label in labels:
-                        for i, j in combinations(np.where(labelimg2 == label)[0], 2):
-                            result[i, j] = result[i, j] + 1
-                            result[j, i] = result[i, j]
-
-                resultname = "%s-res-%s-%i-by_vertex-overlap-sec%i.npz" % (method_name, runid, parcel_num, 100)
-                resultpath = os.path.join(dataroot, resultname)
-                result = csc_matrix(result, dtype=np.int)
-                np.savez(resultpath, result=result)
-                print("Saving {}".format(resultpath))
-                print("Spend time: %f" % (time() - t0))
-
-print("-----------End-----------")
+if __name__ == "__main__":
+    # sessid="/nfs/s1/data/gumpdata/project/sessid"
+    sweep_config = {
+        'projectdir': '/nfs/t3/workingshop/baihaohao/studyforrest',
+        'runids': ["001", "002", "003", "004", "005", "006", "007", "008"],
+        # 'methods': ["KMeans", "hier_clustering", "spectral_clustering", "geo"],
+        'methods': ["KMeans", "hier_clustering", "spectral_clustering"],
+        'parcel_nums': list(range(50, 300, 50)),
+        'repeats': 100,
+        'subj_id': 'fsaverage5',
+        'hemi': 'lh',
+        'surf': 'inflated',
+    }
+    run_vote_sweep(sweep_config, n_jobs=8)
+    print("-----------End-----------")
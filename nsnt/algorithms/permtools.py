@@ -0,0 +1,166 @@
+"""
+Significance testing of ISC and ISFC by permutation and bootstrap.
+
+The statistic is the mean pairwise ISC(or ISFC) of a group of subjects, three types of null distribution are provided:
+circular_shift: time series of every subject are circularly shifted by a random offset.
+phase_randomize: phases of every subject's time series are randomized in the frequency domain.
+bootstrap: subjects are resampled with replacement, pairs of the same subject are excluded.
+"""
+import numpy as np
+
+from nsnt.algorithms.fctools import normalize_rows
+from nsnt.utils.pool_tools import shared_map
+
+NULL_METHODS = ('circular_shift', 'phase_randomize', 'bootstrap')
+
+def _group_stat(total, weights, self_term, pairwise):
+    """
+    Cal mean pairwise ISC(or ISFC) of a batch of surrogates.
+
+    Parameters
+    ----------
+    total: weighted sum of normalized data of subjects in every surrogate,
+        shape = [n_batch, n_samples, n_features].
+    weights: times that every subject appears in a surrogate, shape = [n_batch, n_subjects].
+    self_term: sum of weights ** 2 * (ISC or ISFC of subject with itself), shape = [n_batch, n_samples]
+        (or [n_batch, n_samples, n_samples] for ISFC), which will be removed from the statistic.
+    pairwise: whether calculate ISFC or not.
+
+    Returns
+    -------
+    stat: mean pairwise ISC(or ISFC) of every surrogate, shape = [n_batch, n_samples]
+        (or [n_batch, n_samples, n_samples] for ISFC).
+    """
+    if pairwise:
+        cross = np.einsum('bvt,bwt->bvw', total, total)
+    else:
+        cross = np.sum(total ** 2, axis=-1)
+    n_pairs = np.sum(weights, axis=1) ** 2 - np.sum(weights ** 2, axis=1)
+    n_pairs = np.reshape(n_pairs, (-1,) + (1,) * (cross.ndim - 1))
+    return (cross - self_term) / n_pairs
+
+
+def _self_term(norm_data, weights, pairwise):
+    """Cal self_term used in _group_stat(), see _group_stat() for details."""
+    if pairwise:
+        return np.einsum('bs,svt,swt->bvw', weights ** 2, norm_data, norm_data)
+    return np.einsum('bs,sv->bv', weights ** 2, np.sum(norm_data ** 2, axis=-1))
+
+
+def _null_batch(shared, task):
+    """
+    Cal the null statistic of a batch of surrogates.
+
+    Parameters
+    ----------
+    shared: dict of norm_data, observed, pairwise and spectrum, shared by all batches.
+    task: (method, n_batch, seed) of the batch.
+
+    Returns
+    -------
+    count: number of surrogates whose null statistic is not less than the observed.
+    max_null: max null statistic over samples of every surrogate, shape = [n_batch, ].
+    """
+    method, n_batch, seed = task
+    norm_data, observed, pairwise = shared['norm_data'], shared['observed'], shared['pairwise']
+    n_subjects, n_samples, n_features = norm_data.shape
+    rng = np.random.RandomState(seed)
+
+    if method == 'bootstrap':
+        samples = rng.randint(0, n_subjects, size=(n_batch, n_subjects))
+        # redraw resamples that have less than 2 distinct subjects, which have no pair of subjects.
+        invalid = np.array([np.unique(s).shape[0] < 2 for s in samples], dtype=bool)
+        while np.any(invalid):
+            samples[invalid] = rng.randint(0, n_subjects, size=(np.sum(invalid), n_subjects))
+            invalid = np.array([np.unique(s).shape[0] < 2 for s in samples], dtype=bool)
+        weights = np.array([np.bincount(s, minlength=n_subjects) for s in samples], dtype=np.float64)
+        total = np.einsum('bs,svt->bvt', weights, norm_data)
+        null = _group_stat(total, weights, _self_term(norm_data, weights, pairwise), pairwise)
+        null -= observed  # center bootstrap distribution to get the null.
+    else:
+        weights = np.ones((n_batch, n_subjects))
+        # surrogates of subjects are summed one subject at a time, so only the group sum is kept.
+        total = np.zeros((n_batch, n_samples, n_features))
+        if method == 'circular_shift':
+            shifts = rng.randint(0, n_features, size=(n_batch, n_subjects))
+            time_index = np.arange(n_features)
+            for s in range(n_subjects):
+                # np.roll(x, shift)[t] = x[t - shift]
+                index = (time_index[np.newaxis, :] - shifts[:, [s]]) % n_features
+                total += np.transpose(norm_data[s][:, index], (1, 0, 2))
+        else:
+            spectrum = shared['spectrum']
+            phases = rng.uniform(0, 2 * np.pi, size=(n_batch, n_subjects, spectrum.shape[-1]))
+            phases[..., 0] = 0  # keep mean of time series.
+            if n_features % 2 == 0:
+                phases[..., -1] = 0  # keep the nyquist frequency real.
+            for s in range(n_subjects):
+                total += np.fft.irfft(spectrum[s] * np.exp(1j * phases[:, s])[:, np.newaxis, :],
+                                      n=n_features, axis=-1)
+        # time shift and phase randomization don't change the subject's self term.
+        self_term = _self_term(norm_data, weights[:1], pairwise)
+        null = _group_stat(total, weights, self_term, pairwise)
+
+    count = np.sum(null >= observed, axis=0)
+    max_null = np.max(np.reshape(null, (n_batch, -1)), axis=1)
+    return count, max_null
+
+
+def group_isc_test(data, method='circular_shift', n_perms=1000, pairwise=False, batch_size=10,
+                   n_jobs=1, alpha=0.05, random_state=None):
+    """
+    Test significance of mean pairwise ISC(or ISFC) of a group of subjects.
+
+    Every subject is normalized only once, surrogates are calculated in batch
+        and batches are distributed across a process pool.
+
+    Parameters
+    ----------
+    data: time series of subjects, shape = [n_subjects, n_samples, n_features].
+    method: type of null distribution, one of ['circular_shift', 'phase_randomize', 'bootstrap'],
+        default is 'circular_shift'.
+    n_perms: number of surrogates, default is 1000.
+    pairwise: whether calculate ISFC or not, default is False, means calculate ISC.
+    batch_size: number of surrogates calculated together, default is 10.
+    n_jobs: number of worker processes, default is 1.
+    alpha: significance level of the family-wise error threshold, default is 0.05.
+    random_state: seed of random number generator, default is None.
+
+    Returns
+    -------
+    observed: mean pairwise ISC(or ISFC), shape = [n_samples] (or [n_samples, n_samples] for ISFC).
+    p_values: uncorrected p-value map, same shape as observed.
+    fwe_threshold: max-statistic threshold that controls family-wise error at alpha.
+
+    Notes
+    -----
+    1. bootstrap needs at least 3 subjects, and resamples that have less than 2 distinct subjects are redrawn.
+    2. for bootstrap, the null distribution is the bootstrap distribution centered at observed,
+       and fwe_threshold is the threshold of observed minus its bootstrap mean.
+    """
+    assert method in NULL_METHODS, 'method could only be one of {}.'.format(NULL_METHODS)
+    assert np.ndim(data) == 3 and np.shape(data)[0] > 1, \
+        'data should be 3-d array with at least 2 subjects, got shape {}'.format(np.shape(data))
+
+    n_subjects = np.shape(data)[0]
+    if method == 'bootstrap' and n_subjects < 3:
+        raise ValueError('bootstrap needs at least 3 subjects, got {}.'.format(n_subjects))
+    norm_data = np.array([normalize_rows(subject) for subject in data])
+    weights = np.ones((1, n_subjects))
+    total = np.einsum('bs,svt->bvt', weights, norm_data)
+    observed = _group_stat(total, weights, _self_term(norm_data, weights, pairwise), pairwise)[0]
+    spectrum = np.fft.rfft(norm_data, axis=-1) if method == 'phase_randomize' else None
+
+    seeds = np.random.RandomState(random_state).randint(0, 2 ** 31 - 1, size=n_perms // batch_size + 1)
+    tasks = []
+    for i, start in enumerate(range(0, n_perms, batch_size)):
+        tasks.append((method, min(batch_size, n_perms - start), seeds[i]))
+
+    shared = {'norm_data': norm_data, 'observed': observed, 'pairwise': pairwise, 'spectrum': spectrum}
+    results = list(shared_map(_null_batch, tasks, shared=shared, n_jobs=n_jobs))
+
+    count = np.sum([r[0] for r in results], axis=0)
+    max_null = np.concatenate([r[1] for r in results])
+    p_values = (count + 1.0) / (n_perms + 1.0)
+    fwe_threshold = np.percentile(max_null, 100 * (1 - alpha))
+    return observed, p_values, fwe_threshold
@@ -2,6 +2,7 @@ import os
 
 import numpy as np
 import nibabel as nib
+from scipy import sparse
 
 # TODO specify this function
 # TODO def save_data function for saving data.
@@ -25,6 +26,10 @@ def load_data(filepath, npz_key='arr_0'):
         data = nib.freesurfer.read_annot(filepath)[0]
         return data
 
+    if filename.endswith('.sparse.npz'):
+        data = sparse.load_npz(filepath)
+        return data
+
     if filename.endswith('.npz'):
         data = np.load(filepath)[npz_key]
         return data
@@ -47,3 +52,60 @@ def save_img(data_dir, data_type, filename, data, affine):
     data_file = nib.Nifti1Image(data, affine)
     nib.save(data_file, filepath)
     print("Saving %s" % filepath)
+
+
+class TileStore(object):
+    """
+    On-disk store of a large 2d array, each tile is saved as a .npy file.
+
+    It could be used as the sink of nsnt.algorithms.fctools.isfc_blocked(),
+        which makes it possible to save results that larger than memory.
+
+    Parameters
+    ----------
+    store_dir: directory to save tiles, it will be created if not exists.
+    shape: shape of the full array, used when loading tiles back.
+    dtype: dtype of the full array, default is np.float32.
+    """
+    def __init__(self, store_dir, shape, dtype=np.float32):
+        self.store_dir = store_dir
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def _tile_path(self, row_start, column_start):
+        return os.path.join(self.store_dir, 'tile-{0}-{1}.npy'.format(row_start, column_start))
+
+    def __setitem__(self, key, tile):
+        rows, columns = key
+        np.save(self._tile_path(rows.start, columns.start), np.asarray(tile, dtype=self.dtype))
+
+    def tiles(self):
+        """
+        Iterate over saved tiles.
+
+        Yields
+        ------
+        key: tuple of (row_slice, column_slice), position of tile in the full array.
+        tile: tile array, loaded as memory map.
+        """
+        for filename in sorted(os.listdir(self.store_dir)):
+            if not (filename.startswith('tile-') and filename.endswith('.npy')):
+                continue
+            row_start, column_start = [int(i) for i in filename[5:-4].split('-')]
+            tile = np.load(os.path.join(self.store_dir, filename), mmap_mode='r')
+            key = (slice(row_start, row_start + tile.shape[0]),
+                   slice(column_start, column_start + tile.shape[1]))
+            yield key, tile
+
+    def to_array(self, out=None):
+        """
+        Gather tiles into out, which is an array(or np.memmap) with the full shape.
+        If out is None, create an array in memory.
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        for key, tile in self.tiles():
+            out[key] = tile
+        return out
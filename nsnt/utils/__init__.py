@@ -7,9 +7,18 @@ adj_tools:
 data_stats:
   provide tools to describe statistics of data.
 
+segment_tools:
+  provide tools to reduce data of vertices to labels.
+
 matrix_tools:
   provide tools to handle matrix(like fc matrix).
 
+mask_tools:
+  provide mask of vertices, to compress data into region of interest and expand it back.
+
+pool_tools:
+  provide tools to run tasks in a process pool, with data shared by all tasks.
+
 utils:
   other small but useful tools.
 
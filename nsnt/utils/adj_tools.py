@@ -2,10 +2,26 @@
 Provide tools for get or make matrix, faces, or other forms that reflect adjacent relationships of brain surface.
 """
 import os
-from itertools import combinations
+import shutil
+import hashlib
+import tempfile
 
 import numpy as np
 import nibabel as nib
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from nsnt.utils.mask_tools import VertexMask, as_vertex_mask
+from nsnt.utils.segment_tools import segment_stats
+
+# Geometry loaded by SurfaceGeometry, shared by all instances with the same key.
+# key: (subjects_dir, subj_id, hemi, surf), value: dict of coords, faces and unmasked topology.
+_geometry_registry = {}
+
+
+def clear_geometry_registry():
+    """Remove all loaded geometry from registry, geometry will be loaded again when needed."""
+    _geometry_registry.clear()
 
 
 class SurfaceGeometry(object):
@@ -30,13 +46,26 @@ class SurfaceGeometry(object):
         Triangle meshes of brain surface.
     edges: 2d array of shape (n_edges, 2)
         Edges of brain surface meshes.
-    adjmatrix: 2d array of shape (n_vertexes, n_vertexes)
-        Adjacency matrix that reflect linkages of vertices.
+    adjmatrix: sparse matrix(CSR) of shape (n_vertexes, n_vertexes)
+        Adjacency matrix that reflect linkages of vertices, use adjmatrix.toarray() if dense matrix is needed.
+    vertex_faces: sparse matrix(CSR) of shape (n_vertexes, n_meshes)
+        Incidence matrix of vertices and faces, 1 if the vertex is in the face.
+    neighbors: tuple of (indptr, indices)
+        Neighbor list of vertices, neighbors of vertex i are indices[indptr[i]:indptr[i+1]].
     mask: 1d array of shape (n_vertexes,) | None
-        Apply mask to other property(coords, faces, edges, adjmatrix) if it's not None.
+        Apply mask to other property(coords, faces, edges, adjmatrix, vertex_faces, neighbors) if it's not None.
         1 for vertex you want to keep, others means not needed.
-    """
-    def __init__(self, subj_id, hemi, surf, subjects_dir=None):
+
+    Notes
+    -----
+    1. geometry of the same (subjects_dir, subj_id, hemi, surf) is loaded only once in a process,
+       see clear_geometry_registry().
+    2. topology(edges, adjmatrix, etc.) is calculated when it's first accessed, and cached until
+       mask is changed.
+    3. if cache_dir is given, coords, faces and adjacency are also cached on disk, and loaded
+       as memory map, which makes processes share the same geometry and start quickly.
+    """
+    def __init__(self, subj_id, hemi, surf, subjects_dir=None, cache_dir=None):
         """
         Surface Geometry
 
@@ -49,6 +78,9 @@ class SurfaceGeometry(object):
         subjects_dir: subjects directory, default is None.
             If not None, using this directory as subjects directory.
             Otherwise using the SUBJECTS_DIR of environment variable.
+        cache_dir: directory of on-disk geometry cache, default is None.
+            If None, using the NSNT_GEOMETRY_CACHE of environment variable if it's set,
+            otherwise geometry is not cached on disk.
         """
         if hemi not in ['lh', 'rh']:
             raise ValueError('hemi should be "lh" or "rh" ')
@@ -57,10 +89,22 @@ class SurfaceGeometry(object):
         self.surf = surf
         self.subjects_dir = self._get_subjects_dir(subjects_dir)
 
-        coords, faces = self._load_geo()
-        self._coords = coords
-        self._faces = faces
+        key = (self.subjects_dir, subj_id, hemi, surf)
+        if key not in _geometry_registry:
+            if cache_dir is None:
+                cache_dir = os.environ.get('NSNT_GEOMETRY_CACHE', '')
+            if cache_dir:
+                _geometry_registry[key] = self._load_cached_geo(cache_dir)
+            else:
+                coords, faces = self._load_geo()
+                _geometry_registry[key] = {'coords': coords, 'faces': faces, 'topology': {}}
+        geometry = _geometry_registry[key]
+        self._coords = geometry['coords']
+        self._faces = geometry['faces']
+        self._topology = geometry['topology']  # unmasked topology, shared with other instances.
+        self._masked_topology = {}
         self._mask = None
+        self._vertex_mask = None
 
     def _load_geo(self):
         """
@@ -77,11 +121,54 @@ class SurfaceGeometry(object):
         faces: 2d array of shape (n_meshes, 3)
             Triangle meshes of brain surface.
         """
-        geo_path = os.path.join(self.subjects_dir, self.subj_id, 'surf',
-                                '{}.{}'.format(self.hemi, self.surf))
-        coords, faces = nib.freesurfer.read_geometry(geo_path)
+        coords, faces = nib.freesurfer.read_geometry(self._geo_path())
         return coords, faces
 
+    def _geo_path(self):
+        """Get path of the surface file."""
+        return os.path.join(self.subjects_dir, self.subj_id, 'surf',
+                            '{}.{}'.format(self.hemi, self.surf))
+
+    def _load_cached_geo(self, cache_dir):
+        """
+        Get coords, faces and unmasked topology from on-disk cache,
+            cache is rebuilt if it does not exist or the surface file is changed.
+
+        An example of cache path:
+            Assume subj_id = 'fsaverage', hemi = 'lh', surf = 'inflated'
+            cache path: cache_dir/fsaverage/lh.inflated/
+
+        Returns
+        -------
+        geometry: dict of coords, faces and topology.
+        """
+        cache_path = os.path.join(cache_dir, self.subj_id, '{}.{}'.format(self.hemi, self.surf))
+        checksum = _file_checksum(self._geo_path())
+        geometry = load_geometry_cache(cache_path, checksum)
+        if geometry is None:
+            coords, faces = self._load_geo()
+            adjm = faces_to_adjmatrix(faces, n_vertexes=coords.shape[0])
+            save_geometry_cache(cache_path, checksum, coords, faces, adjm)
+            geometry = load_geometry_cache(cache_path, checksum)
+            if geometry is None:  # cache is being replaced by another process, use geometry in memory.
+                geometry = {'coords': coords, 'faces': faces,
+                            'topology': {'adjmatrix': adjm, 'neighbors': (adjm.indptr, adjm.indices)}}
+        return geometry
+
+    def _get_topology(self, name, build):
+        """
+        Get topology from cache, build and cache it if not exists.
+
+        Parameters
+        ----------
+        name: name of topology.
+        build: function that build the topology, build(faces, mask), mask may be None.
+        """
+        cache = self._topology if self._mask is None else self._masked_topology
+        if name not in cache:
+            cache[name] = build(self._faces, self._vertex_mask)
+        return cache[name]
+
     @property
     def coords(self):
         """
@@ -90,7 +177,7 @@ class SurfaceGeometry(object):
             which may change shape of output.
         """
         if self._mask is not None:
-            return self._coords[np.where(self._mask == 1)]
+            return self._vertex_mask.compress(self._coords)
         return self._coords
 
     @property
@@ -101,7 +188,7 @@ class SurfaceGeometry(object):
             which may change shape of output.
         """
         if self._mask is not None:
-            return _apply_mask(self._faces, mask=self._mask)
+            return self._get_topology('faces', lambda faces, mask: _apply_mask(faces, mask=mask))
         return self._faces
 
     @property
@@ -111,22 +198,40 @@ class SurfaceGeometry(object):
         If mask is not None, then apply mask on result,
             which may change shape of output.
         """
-        edges = faces_to_edges(self._faces)
-        if self._mask is not None:
-            return _apply_mask(edges, mask=self._mask)
-        return edges
+        return self._get_topology('edges', lambda faces, mask: faces_to_edges(faces, mask=mask))
 
     @property
     def adjmatrix(self):
         """
-        Get adjacency matrix of vertices.
+        Get adjacency matrix of vertices, as a sparse matrix(CSR).
         If mask is not None, then apply mask on result,
             which may change shape of output.
         """
-        adjm = faces_to_adjmatrix(self._faces)
-        if self._mask is not None:
-            return _apply_mask_on_adjm(adjm, mask=self._mask)
-        return adjm
+        n_vertexes = self._coords.shape[0]
+        return self._get_topology('adjmatrix', lambda faces, mask: faces_to_adjmatrix(faces, mask=mask,
+                                                                                      n_vertexes=n_vertexes))
+
+    @property
+    def vertex_faces(self):
+        """
+        Get incidence matrix of vertices and faces, as a sparse matrix(CSR).
+        If mask is not None, then faces that contain masked vertices are removed,
+            which may change shape of output.
+        """
+        n_vertexes = self._coords.shape[0]
+        return self._get_topology('vertex_faces', lambda faces, mask: faces_to_incidence(
+            _apply_mask(faces, mask=mask), n_vertexes=n_vertexes))
+
+    @property
+    def neighbors(self):
+        """
+        Get neighbor list of vertices, as a tuple of (indptr, indices),
+            neighbors of vertex i are indices[indptr[i]:indptr[i+1]].
+        If mask is not None, then apply mask on result,
+            which may change shape of output.
+        """
+        adjm = self.adjmatrix
+        return self._get_topology('neighbors', lambda faces, mask: (adjm.indptr, adjm.indices))
 
     @property
     def mask(self):
@@ -141,14 +246,17 @@ class SurfaceGeometry(object):
         This method has no return, it works when accessing the property.
         If mask is not needed, set it to None.
         """
+        self._masked_topology = {}
         if mask is None:
             self._mask = None
+            self._vertex_mask = None
             return None
 
         if not (isinstance(mask, np.ndarray) or isinstance(mask, list)):
             raise TypeError('The type of mask could only be ndarray or list')
         mask = np.reshape(mask, (-1))
         self._mask = mask
+        self._vertex_mask = VertexMask(mask)
 
     def apply_mask(self, mask):
         """
@@ -174,6 +282,100 @@ class SurfaceGeometry(object):
         return subjects_dir
 
 
+def _file_checksum(filepath):
+    """Get md5 checksum of file."""
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+_cache_files = ('coords', 'faces', 'adj_indptr', 'adj_indices')
+
+
+def _read_checksum(cache_path):
+    """Get checksum saved in cache_path, None if it does not exist."""
+    try:
+        with open(os.path.join(cache_path, 'checksum')) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def save_geometry_cache(cache_path, checksum, coords, faces, adjm):
+    """
+    Save geometry into cache_path as .npy files, with the checksum of its surface file.
+
+    Parameters
+    ----------
+    cache_path: directory to save the cache.
+    checksum: checksum of surface file.
+    coords: coordinates of vertices, shape = (n_vertices, 3).
+    faces: triangle meshes of brain surface, shape = (n_meshes, 3).
+    adjm: sparse adjacency matrix of vertices, shape = (n_vertices, n_vertices).
+    """
+    adjm = sparse.csr_matrix(adjm)
+    arrays = {'coords': coords, 'faces': faces, 'adj_indptr': adjm.indptr, 'adj_indices': adjm.indices}
+
+    # write into a temporary dir and rename it, to avoid other processes loading incomplete cache.
+    parent_dir = os.path.dirname(os.path.abspath(cache_path))
+    if not os.path.exists(parent_dir):
+        os.makedirs(parent_dir)
+    temp_path = tempfile.mkdtemp(dir=parent_dir)
+    for name in _cache_files:
+        np.save(os.path.join(temp_path, name + '.npy'), arrays[name])
+    with open(os.path.join(temp_path, 'checksum'), 'w') as f:
+        f.write(checksum)
+
+    # another process may have saved a valid cache since this one was found missing.
+    if _read_checksum(cache_path) == checksum:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        return
+    if os.path.exists(cache_path):
+        # move the stale cache aside before removing it, so cache_path is never half removed.
+        stale_path = tempfile.mkdtemp(dir=parent_dir)
+        try:
+            os.rename(cache_path, os.path.join(stale_path, 'stale'))
+        except OSError:  # removed by another process.
+            pass
+        shutil.rmtree(stale_path, ignore_errors=True)
+    try:
+        os.rename(temp_path, cache_path)
+    except OSError:  # another process has saved the cache.
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def load_geometry_cache(cache_path, checksum):
+    """
+    Load geometry from cache_path as memory map.
+
+    Parameters
+    ----------
+    cache_path: directory of the cache.
+    checksum: checksum of surface file, cache is invalid if it does not match.
+
+    Returns
+    -------
+    geometry: dict of coords, faces and topology(adjmatrix, neighbors),
+        None if the cache does not exist or is invalid.
+    """
+    if _read_checksum(cache_path) != checksum:
+        return None
+
+    try:
+        arrays = dict((name, np.load(os.path.join(cache_path, name + '.npy'), mmap_mode='r'))
+                      for name in _cache_files)
+    except (IOError, OSError, ValueError):  # cache is being replaced by another process.
+        return None
+    n_vertexes = arrays['coords'].shape[0]
+    indptr, indices = arrays['adj_indptr'], arrays['adj_indices']
+    adjm = sparse.csr_matrix((np.ones(indices.shape[0]), indices, indptr), shape=(n_vertexes, n_vertexes),
+                             copy=False)
+    topology = {'adjmatrix': adjm, 'neighbors': (indptr, indices)}
+    return {'coords': arrays['coords'], 'faces': arrays['faces'], 'topology': topology}
+
+
 def _apply_mask(data, mask=None):
     """
     Apply mask to faces or edges by delete masked data.
@@ -181,7 +383,7 @@ def _apply_mask(data, mask=None):
     Parameters
     ----------
     data: inout data, should be faces or edges.
-    mask: binary array, 1 for region of interest and 0 for others, shape = (n_vertexes,).
+    mask: binary array(or VertexMask), 1 for region of interest and 0 for others, shape = (n_vertexes,).
 
     Return
     ------
@@ -189,15 +391,7 @@ def _apply_mask(data, mask=None):
     """
     if mask is None:
         return data
-
-    mask_1dim = np.reshape(mask, (-1))
-    masked_verts = np.where(mask_1dim == 0)[0]
-    index = []
-    for vert in masked_verts:
-        index = np.concatenate([index, np.where(data == vert)[0]])
-    index = np.unique(index).astype(np.int)
-    result = np.delete(data, index, axis=0)
-    return result
+    return as_vertex_mask(mask).compress_faces(data)
 
 
 def _apply_mask_on_adjm(adjm, mask=None):
@@ -206,8 +400,8 @@ def _apply_mask_on_adjm(adjm, mask=None):
 
     Parameters
     ----------
-    adjm: input data, should be faces or edges.
-    mask: binary array, 1 for region of interest and 0 for others, shape = (n_vertexes,).
+    adjm: input adjacency matrix, array or sparse matrix, shape = (n_vertexes, n_vertexes).
+    mask: binary array(or VertexMask), 1 for region of interest and 0 for others, shape = (n_vertexes,).
 
     Return
     ------
@@ -215,10 +409,7 @@ def _apply_mask_on_adjm(adjm, mask=None):
     """
     if mask is None:
         return adjm
-
-    adjm = np.delete(adjm, mask, axis=0)
-    adjm = np.delete(adjm, mask, axis=1)
-    return adjm
+    return as_vertex_mask(mask).compress_adjmatrix(adjm)
 
 
 def faces_to_edges(faces, mask=None):
@@ -232,45 +423,46 @@ def faces_to_edges(faces, mask=None):
 
     Returns
     -------
-    edges: array, edges of brain surface mesh, shape=(n_edges, 2)
-    """
-    edges = np.empty((0, 2))
-    for face in faces:
-        for edge in combinations(face, 2):
-            if np.any(np.all(edge == edges, axis=1)):  # check whether edge in edges
-                continue
-            if np.any(np.all(edge[::-1] == edges, axis=1)):  # check whether edge in edges
-                continue
-            edges = np.append(edges, np.reshape(edge, (1, 2)),  axis=0)
+    edges: array, edges of brain surface mesh, shape=(n_edges, 2),
+        every edge is sorted as (small_vertex, large_vertex), and edges are sorted by rows.
+    """
+    faces = np.asarray(faces)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [0, 2]]], axis=0)
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
     edges = _apply_mask(edges, mask)
     return edges
 
 
-def edges_to_adjmatrix(edges, mask=None):
+def edges_to_adjmatrix(edges, mask=None, dense=False, n_vertexes=None):
     """
-    Build edges array from faces.
+    Build adjacency matrix from edges.
 
     Parameters
     ----------
     edges: edge linkages of brain surface, shape=(n_edges, 2).
     mask: binary array, 1 for region of interest and 0 for others, shape = (n_vertexes,).
+    dense: whether return dense array or not, default is False, means return sparse matrix(CSR).
+        Notice: dense matrix may cause memory error for large number of vertexes.
+    n_vertexes: number of vertexes, default is None, means max vertex in edges + 1.
 
     Returns
     -------
     adjm: adjacency matrix that reflect linkages of edges, shape = (n_vertexes, n_vertexes).
     """
-    vertexes = np.unique(edges)
-    n_vertexes = len(vertexes)
-    adjm = np.zeros((n_vertexes, n_vertexes))
-
-    for edge in edges:
-        adjm[edge[0], edge[1]] = 1
-        adjm[edge[1], edge[0]] = 1
+    edges = np.asarray(edges, dtype=int)
+    if n_vertexes is None:
+        n_vertexes = np.max(edges) + 1
+    rows = np.concatenate([edges[:, 0], edges[:, 1]])
+    columns = np.concatenate([edges[:, 1], edges[:, 0]])
+    adjm = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(n_vertexes, n_vertexes))
+    adjm.data[:] = 1  # duplicate edges are summed when building matrix.
     adjm = _apply_mask_on_adjm(adjm, mask=mask)
+    if dense:
+        return adjm.toarray()
     return adjm
 
 
-def faces_to_adjmatrix(faces, mask=None):
+def faces_to_adjmatrix(faces, mask=None, dense=False, n_vertexes=None):
     """
     Build adjacency matrix by faces.
 
@@ -278,21 +470,36 @@ def faces_to_adjmatrix(faces, mask=None):
     ----------
     faces: triangles mesh of brain surface, shape=(n_mesh, 3).
     mask: binary array, 1 for region of interest and 0 for others, shape = (n_vertexes,).
+    dense: whether return dense array or not, default is False, means return sparse matrix(CSR).
+        Notice: dense matrix may cause memory error for large number of vertexes.
+    n_vertexes: number of vertexes, default is None, means max vertex in faces + 1.
 
     Returns
     -------
     adjm: adjacency matrix that reflect linkages of faces, shape = (n_vertexes, n_vertexes).
     """
-    vertexes = np.unique(faces)
-    n_vertexes = len(vertexes)
-    adjm = np.zeros((n_vertexes, n_vertexes))
+    return edges_to_adjmatrix(faces_to_edges(faces), mask=mask, dense=dense, n_vertexes=n_vertexes)
 
-    for face in faces:
-        for edge in combinations(face, 2):
-            adjm[edge[0], edge[1]] = 1
-            adjm[edge[1], edge[0]] = 1
-    adjm = _apply_mask_on_adjm(adjm, mask=mask)
-    return adjm
+
+def faces_to_incidence(faces, n_vertexes=None):
+    """
+    Build incidence matrix of vertexes and faces.
+
+    Parameters
+    ----------
+    faces: triangles mesh of brain surface, shape=(n_mesh, 3).
+    n_vertexes: number of vertexes, default is None, means max vertex in faces + 1.
+
+    Returns
+    -------
+    incidence: sparse matrix(CSR), 1 if the vertex is in the face, shape = (n_vertexes, n_mesh).
+    """
+    faces = np.asarray(faces, dtype=int)
+    if n_vertexes is None:
+        n_vertexes = np.max(faces) + 1
+    n_faces = faces.shape[0]
+    return sparse.csr_matrix((np.ones(faces.size), (faces.ravel(), np.repeat(np.arange(n_faces), 3))),
+                             shape=(n_vertexes, n_faces))
 
 
 def faces_to_dict(faces):
@@ -307,15 +514,57 @@ def faces_to_dict(faces):
     -------
     adj_dict: dict of adjacent faces, key is id of node in faces, value is neighbors of the node.
     """
-    label_list = np.unique(faces)
+    node_list, faces_index = np.unique(faces, return_inverse=True)
+    faces_index = np.reshape(faces_index, np.shape(faces))
+    _, _, (indptr, indices) = mk_label_graph(node_list, faces=faces_index)
     adj_dict = dict()
-    for label in label_list:
-        adj_list = list(np.unique(faces[np.where(faces == label)[0]]))
-        adj_list.remove(label)
-        adj_dict[label] = adj_list
+    for i, node in enumerate(node_list):
+        adj_dict[node] = list(node_list[indices[indptr[i]:indptr[i + 1]]])
     return adj_dict
 
 
+def mk_label_graph(label_image, faces=None, adjm=None, mask=None):
+    """
+    Calculate adjacency of labels in label_image, based on faces(or adjacency matrix) of vertexes.
+
+    Every edge of vertexes is mapped to a pair of labels at once, two labels are adjacent
+        if there is an edge between their vertexes.
+
+    Parameters
+    ----------
+    label_image: labels of vertexes, shape = (n, ).
+    faces: faces of vertexes, its shape depends on surface, shape = (m, 3).
+    adjm: adjacency matrix of vertexes, shape = (n, n), if given, faces will not be used, default is None.
+    mask: binary array, 1 for region of interest and 0 for others, shape = (n, ),
+        labels that have no vertex in region of interest are dropped, default is None.
+
+    Returns
+    -------
+    label_list: unique labels in the graph, shape = (l, ).
+    label_adjmatrix: binary adjacency matrix of labels, sparse matrix(CSR), shape = (l, l),
+        row i is label_list[i].
+    neighbors: neighbors of labels (indptr, indices), neighbors of label_list[i] are
+        label_list[indices[indptr[i]:indptr[i + 1]]].
+    """
+    label_image = np.reshape(label_image, (-1))
+    if mask is None:
+        label_list = np.unique(label_image)
+    else:
+        label_list = np.unique(label_image[np.reshape(mask, (-1)) == 1])
+
+    adjm = sparse.coo_matrix(_to_adjmatrix(faces, adjm, label_image.shape[0]))
+    label1, label2 = label_image[adjm.row], label_image[adjm.col]
+    keep = (label1 != label2) & np.isin(label1, label_list) & np.isin(label2, label_list)
+    index1 = np.searchsorted(label_list, label1[keep])
+    index2 = np.searchsorted(label_list, label2[keep])
+
+    l = label_list.shape[0]
+    label_adjmatrix = sparse.csr_matrix((np.ones(index1.shape[0]), (index1, index2)), shape=(l, l))
+    label_adjmatrix = ((label_adjmatrix + label_adjmatrix.T) > 0).astype(np.float64)
+    label_adjmatrix.sort_indices()
+    return label_list, label_adjmatrix, (label_adjmatrix.indptr, label_adjmatrix.indices)
+
+
 def mk_label_adjmatrix(label_image, adjmatrix):
     """
     Calculate adjacent matrix of labels in label_image, based on adjacent matrix of vertexes.
@@ -323,30 +572,14 @@ def mk_label_adjmatrix(label_image, adjmatrix):
     Parameters
     ----------
     label_image: labels of vertexes, shape = (n, ), n is number of vertexes.
-    adjmatrix: adjacent matrix of vertexes, shape = (n, n).
+    adjmatrix: adjacent matrix of vertexes, array or sparse matrix, shape = (n, n).
 
     Returns
     -------
     label_adjmatrix: adjacent matrix of labels, shape = (l, l), l is number of labels.
-
-    Notes
-    -----
-    1. for large number of vertexes, this method may cause memory error, try to use mk_label_adjfaces().
     """
-    labels = np.unique(label_image)
-    l, n = len(labels), len(label_image)
-    temp_matrix = np.zeros((l, n))
-    label_adjmatrix = np.zeros((l, l))
-    for i, label in enumerate(labels):
-        temp_matrix[i, :] = np.sum(adjmatrix[np.where(label_image == label)[0], :], axis=0)
-
-    for i, label in enumerate(labels):
-        label_adjmatrix[:, i] = np.sum(temp_matrix[:, np.where(label_image == label)[0]], axis=1).T
-
-    # making binary adjmatrix
-    label_adjmatrix[np.where(label_adjmatrix > 0)] = 1
-    label_adjmatrix[range(l), range(l)] = 0
-    return label_adjmatrix
+    _, label_adjmatrix, _ = mk_label_graph(label_image, adjm=adjmatrix)
+    return label_adjmatrix.toarray()
 
 
 def mk_label_adjfaces(label_image, faces, mask=None):
@@ -363,26 +596,16 @@ def mk_label_adjfaces(label_image, faces, mask=None):
     -------
     label_faces: faces of labels, shape = (l, 3).
     """
-    label_face = np.copy(faces)
-    for i in faces:
-        label_face[np.where(faces == i)[0]] = [label_image[i[0]], label_image[i[1]], label_image[i[2]]]
-    label_faces_rde = np.array(list(set([tuple(column) for column in label_face])))  # remove duplicate elements
-    label_faces = np.empty((0, 3))
-    for column in label_faces_rde:
-        if np.unique(column).shape[0] != 1:
-            label_faces = np.append(label_faces, [column], axis=0)  # keep face elements only
-    label_faces = np.array(label_faces)
+    label_image = np.reshape(label_image, (-1))
+    label_faces = label_image[np.asarray(faces, dtype=int)]
+    # keep faces that cross the border of labels, and remove duplicate faces.
+    label_faces = label_faces[~np.all(label_faces == label_faces[:, [0]], axis=1)]
+    label_faces = np.unique(label_faces, axis=0)
 
     if mask is not None:
         # get different label number before and after mask as the droped label.
-        label_droped = np.setdiff1d(label_image, label_image[np.where(mask == 1)])
-
-        index = []
-        for label in label_droped:
-            index = np.concatenate([index, np.where(label_faces == label)[0]])
-
-        index = np.unique(index).astype(np.int)
-        label_faces = np.delete(label_faces, index, axis=0)
+        label_droped = np.setdiff1d(label_image, label_image[np.where(np.reshape(mask, (-1)) == 1)])
+        label_faces = label_faces[~np.any(np.isin(label_faces, label_droped), axis=1)]
     return label_faces
 
 
@@ -472,6 +695,48 @@ def get_verts_edges(vertices, edges, keep_neighbor=False):
     return verts_edges_rde
 
 
+def _to_adjmatrix(faces, adjm, n_vertexes):
+    """Get sparse adjacency matrix, build it from faces if adjm is None."""
+    if adjm is None:
+        return faces_to_adjmatrix(faces, n_vertexes=n_vertexes)
+    return sparse.csr_matrix(adjm)
+
+
+def label_components(labels, faces=None, adjm=None):
+    """
+    Find connected components of every label in labels.
+
+    Only edges between vertexes of the same label are kept, then connected
+        components of the whole label image are found at once.
+
+    Parameters
+    ----------
+    labels: labeling of all vertexes, shape = (n_vertexes, ).
+    faces: faces of vertexes, its shape depends on surface, shape = (n_faces, 3).
+    adjm: adjacency matrix of vertexes, shape = (n_vertexes, n_vertexes),
+        if given, faces will not be used, default is None.
+
+    Returns
+    -------
+    components: component index of every vertex, shape = (n_vertexes, ),
+        components are numbered by their first vertex.
+    component_labels: label of every component, shape = (n_components, ).
+    """
+    labels = np.asarray(labels)
+    adjm = _to_adjmatrix(faces, adjm, labels.shape[0]).tocoo()
+    same = labels[adjm.row] == labels[adjm.col]
+    graph = sparse.csr_matrix((np.ones(np.count_nonzero(same)), (adjm.row[same], adjm.col[same])),
+                              shape=adjm.shape)
+    _, components = connected_components(graph, directed=False)
+
+    # renumber components by their first vertex.
+    _, first_vertex, components = np.unique(components, return_index=True, return_inverse=True)
+    order = np.argsort(first_vertex)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+    return rank[components], labels[first_vertex[order]]
+
+
 def nonconnected_labels(labels, faces, showinfo=False):
     """
     Check if every label in labels is a connected component.
@@ -493,28 +758,13 @@ def nonconnected_labels(labels, faces, showinfo=False):
     """
     # TODO fix medial wall labels.
     max_label = np.max(labels)
-    label_list = []
-    for i in range(max_label):
-        vertexes = np.array(np.where(labels == i)).flatten()
-        visited = []
-        neighbors = [vertexes[0]]
-
-        while neighbors:
-            vertex = neighbors.pop(0)
-            visited.append(vertex)
-            neigh = np.unique(faces[np.where(faces == vertex)[0]])
-            for vert in neigh:
-                if vert in vertexes:
-                    if (vert not in visited) and (vert not in neighbors):
-                            neighbors.append(vert)
-
-        for vert in vertexes:
-            if vert not in visited:
-                if showinfo:
-                    print("Label %i is not a connected component." % i)
-                label_list.append(i)
-                break
-    return label_list
+    _, component_labels = label_components(labels, faces)
+    label_list, component_number = np.unique(component_labels, return_counts=True)
+    label_list = label_list[(component_number > 1) & (label_list < max_label)]
+    if showinfo:
+        for i in label_list:
+            print("Label %i is not a connected component." % i)
+    return list(label_list)
 
 
 def connected_components_labeling(vertexes, faces):
@@ -528,32 +778,14 @@ def connected_components_labeling(vertexes, faces):
 
     Return
     ------
-    marks: marks of vertexes, used to split vertexes into different connected components.
+    marks: marks of vertexes, used to split vertexes into different connected components,
+        marks start from 1, and are numbered by the order of vertexes.
     """
-    mark = 0
-    marks = np.zeros_like(vertexes)
-
-    for vertex in vertexes:
-        # since labeling would make marks value change,
-        # there is no need relabel vertex which has already
-        # be labeled.
-        if marks[np.where(vertexes == vertex)[0]] != 0:
-            continue
-
-        mark = mark + 1
-        neighbors = [vertex]
-        while neighbors:
-            vert = neighbors.pop(0)
-            marks[np.where(vertexes == vert)[0]] = mark
-            neigh = np.unique(faces[np.where(faces == vert)[0]])
-            for vert in neigh:
-                if vert in vertexes:
-                    if (marks[np.where(vertexes == vert)[0]] == 0) and (vert not in neighbors):
-                        neighbors.append(vert)
-                        marks[np.where(vertexes == vert)[0]] = mark
-        if np.all(marks):
-            break
-    return marks
+    vertexes = np.asarray(vertexes, dtype=int)
+    n_vertexes = max(np.max(faces), np.max(vertexes)) + 1
+    adjm = faces_to_adjmatrix(faces, n_vertexes=n_vertexes)[vertexes][:, vertexes]
+    components, _ = label_components(np.zeros(vertexes.shape[0], dtype=int), adjm=adjm)
+    return components + 1
 
 
 def merge_small_parts(data, labels, faces, parcel_size, showinfo=False):
@@ -578,37 +810,44 @@ def merge_small_parts(data, labels, faces, parcel_size, showinfo=False):
     ------
     result_label: labels after merging small parcel.
     """
-    nonc_labels = nonconnected_labels(labels, faces)
+    labels = np.asarray(labels)
+    adjm = faces_to_adjmatrix(faces, n_vertexes=labels.shape[0])
+    components, component_labels = label_components(labels, adjm=adjm)
+    max_label = np.max(labels)
+    label_list, component_number = np.unique(component_labels, return_counts=True)
+    nonc_labels = label_list[(component_number > 1) & (label_list < max_label)]
+
     result_label = np.copy(labels)
-    for nonc_label in nonc_labels:
-        vertexes = np.where(labels == nonc_label)[0]
-        marks = connected_components_labeling(vertexes, faces)
-
-        for m in np.unique(marks):
-            verts = vertexes[np.where(marks == m)]
-            if showinfo:
-                print("small cluster: {0}: {1}: {2}".format(nonc_label, m, verts.shape))
-
-            if verts.shape[0] < parcel_size:
-                verts_data = np.mean(data[verts], axis=0)
-                verts_neigh_faces = get_verts_faces(verts, faces)
-                neigh_labels = np.setdiff1d(np.unique(result_label[np.unique(verts_neigh_faces).astype(int)]),
-                                            nonc_label)
-                temp_corr = None
-
-                for neigh_label in neigh_labels:
-                    neigh_data = np.mean(data[np.where(result_label == neigh_label)], axis=0)
-                    neigh_corr = np.corrcoef(neigh_data, verts_data)[0][1]
-                    if neigh_corr > temp_corr:
-                        temp_corr = neigh_corr
-                        labelid = neigh_label
-                if showinfo:
-                    print("Set label {0} to verts, correlation: {1}.".format(labelid, temp_corr))
-                result_label[verts] = labelid
+    # sum of data in every label is updated when a component is merged, so mean data is not recalculated.
+    label_list, label_sum, _, _, label_size = segment_stats(data, labels, variance=False)
+    _, component_sum, _, _, component_size = segment_stats(data, components, variance=False)
+    for m in np.where(np.isin(component_labels, nonc_labels) & (component_size < parcel_size))[0]:
+        nonc_label = component_labels[m]
+        verts = np.where(components == m)[0]
+        if showinfo:
+            print("small cluster: {0}: {1}: {2}".format(nonc_label, m, verts.shape))
+
+        neigh_labels = np.setdiff1d(result_label[adjm[verts].indices], nonc_label)
+        if neigh_labels.shape[0] == 0:
+            continue
+        verts_data = component_sum[m] / component_size[m]
+        neigh_corr = [np.corrcoef(label_sum[i] / label_size[i], verts_data)[0][1]
+                      for i in np.searchsorted(label_list, neigh_labels)]
+        if np.all(np.isnan(neigh_corr)):
+            continue
+        labelid = neigh_labels[np.nanargmax(neigh_corr)]
+        if showinfo:
+            print("Set label {0} to verts, correlation: {1}.".format(labelid, np.nanmax(neigh_corr)))
+        result_label[verts] = labelid
+        old_index, new_index = np.searchsorted(label_list, [nonc_label, labelid])
+        label_sum[old_index] -= component_sum[m]
+        label_sum[new_index] += component_sum[m]
+        label_size[old_index] -= component_size[m]
+        label_size[new_index] += component_size[m]
     return result_label
 
 
-def split_connected_components(labels, faces, showinfo=False):
+def split_connected_components(labels, faces, showinfo=False, adjm=None):
     """
     Split connected components in same label into different labels.
 
@@ -617,24 +856,32 @@ def split_connected_components(labels, faces, showinfo=False):
     labels: labeling of all vertexes, shape = (n_vertexes, ).
     faces: faces of vertexes, its shape depends on surface, shape = (n_faces, 3).
     showinfo: whether print details or not, default is False.
+    adjm: adjacency matrix of vertexes, if given, faces will not be used, default is None.
 
     Return
     ------
     result_label: labels after spliting connected components in same label.
+
+    Notes
+    -----
+    1. component that contains the first vertex of the label keeps the label number,
+       other components get new label numbers from max label + 1.
+    2. the max label number in labels should be assigned to the medial wall, and it's not split.
     """
-    nonc_labels = nonconnected_labels(labels, faces, showinfo)
-    new_label = np.max(labels) + 1
-    result_label = np.copy(labels)
-    for nonc_label in nonc_labels:
-        vertexes = np.where(labels == nonc_label)[0]
-        marks = connected_components_labeling(vertexes, faces)
-
-        for m in np.unique(marks):
-            verts = vertexes[np.where(marks == m)]
-            if showinfo:
-                print("small cluster: {0}: {1}: {2}".format(nonc_label, m, verts.shape))
-            if m > 1:  # keep label of group m==1.
-                result_label[verts] = new_label
-                new_label = new_label + 1
+    labels = np.asarray(labels)
+    components, component_labels = label_components(labels, faces, adjm)
+    max_label = np.max(labels)
+
+    # components are numbered by first vertex, so the first component of every label keeps the label.
+    order = np.argsort(component_labels, kind='mergesort')
+    sorted_labels = component_labels[order]
+    to_split = np.concatenate([[False], sorted_labels[1:] == sorted_labels[:-1]]) & (sorted_labels < max_label)
+    new_labels = np.copy(component_labels)
+    new_labels[order[to_split]] = max_label + 1 + np.arange(np.count_nonzero(to_split))
+    if showinfo:
+        for m in order[to_split]:
+            print("small cluster: {0}: {1}: {2}".format(component_labels[m], m, np.count_nonzero(components == m)))
+
+    result_label = new_labels[components]
     print("Label number after processing: {0}".format(np.max(result_label)))
     return result_label
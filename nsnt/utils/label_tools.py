@@ -1,7 +1,11 @@
+import multiprocessing
+
 import numpy as np
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
 
-from nsnt.algorithms.evaltools import dice_matrix
-from nsnt.utils.adj_tools import connected_components_labeling
+from nsnt.algorithms.evaltools import dice_matrix, contingency_matrix
+from nsnt.utils.adj_tools import label_components
 
 
 def get_label_contour(labels, faces, medial_wall_label=None):
@@ -200,6 +204,109 @@ def reglabel(baselabels, adjustlabels, return_matched_number=False, show_info=Fa
     return baselabels, reglabels
 
 
+def match_labels(baselabels, adjustlabels):
+    """
+    Register adjustlabels to baselabels by optimal assignment of labels, which maximizes
+      the total dice coefficient of matched label pairs (Hungarian algorithm).
+
+    Parameters
+    ----------
+    baselabels: cluster labels, shape = [n_samples].
+    adjustlabels: cluster labels, shape = [n_samples].
+
+    Returns
+    -------
+    reglabels: adjustlabels after registration, shape = [n_samples].
+               matched labels get label number of baselabels, unmatched labels get new
+               label numbers from max label of baselabels + 1.
+    matched_number: number of matched labels.
+    """
+    label_list1, label_list2, contingency = contingency_matrix(baselabels, adjustlabels)
+    size1 = np.asarray(contingency.sum(axis=1)).ravel()
+    size2 = np.asarray(contingency.sum(axis=0)).ravel()
+    dice_mat = 2.0 * contingency.toarray() / (size1[:, np.newaxis] + size2[np.newaxis, :])
+
+    rows, columns = linear_sum_assignment(-dice_mat)
+    # label pairs without overlap are not matched.
+    overlapped = dice_mat[rows, columns] > 0
+    rows, columns = rows[overlapped], columns[overlapped]
+
+    new_list = np.empty(label_list2.shape[0], dtype=np.result_type(label_list1, label_list2))
+    new_list[columns] = label_list1[rows]
+    unmatched = np.setdiff1d(np.arange(label_list2.shape[0]), columns)
+    new_list[unmatched] = np.max(label_list1) + 1 + np.arange(unmatched.shape[0])
+
+    index2 = np.searchsorted(label_list2, adjustlabels)
+    return new_list[index2], rows.shape[0]
+
+
+def _match_labels(args):
+    return match_labels(*args)
+
+
+def _mode_labels(label_images):
+    """Get the most frequent label of every vertex in label_images."""
+    label_list, index = np.unique(label_images, return_inverse=True)
+    index = np.reshape(index, np.shape(label_images))
+    n_images, n_vertices = index.shape
+    vertices = np.tile(np.arange(n_vertices), n_images)
+    counts = sparse.csr_matrix((np.ones(index.size), (vertices, index.ravel())),
+                               shape=(n_vertices, label_list.shape[0]))
+    return label_list[np.asarray(counts.argmax(axis=1)).ravel()]
+
+
+def register_labels(label_images, reference=None, n_iter=10, n_jobs=1, show_info=False):
+    """
+    Register a stack of label images to a reference, or to an iteratively refined consensus.
+
+    Every label image is registered by match_labels(), label images are distributed across
+      a process pool.
+    If reference is None, the first label image is used as the initial reference, and the
+      reference is replaced by the consensus(the most frequent label of every vertex) of
+      registered label images, until it does not change or n_iter is reached.
+
+    Parameters
+    ----------
+    label_images: cluster labels of repeated parcellations, shape = [n_images, n_samples].
+    reference: cluster labels, shape = [n_samples], default is None, means using the consensus.
+    n_iter: max number of iterations to refine consensus, default is 10.
+    n_jobs: number of worker processes, default is 1.
+    show_info: whether print details or not, default is False.
+
+    Returns
+    -------
+    reglabels: label images after registration, shape = [n_images, n_samples].
+    reference: reference labels(or the final consensus), shape = [n_samples].
+    """
+    label_images = np.asarray(label_images)
+    use_consensus = reference is None
+    if use_consensus:
+        reference = label_images[0]
+    else:
+        n_iter = 1
+
+    pool = multiprocessing.Pool(n_jobs) if n_jobs != 1 else None
+    try:
+        for i in range(n_iter):
+            tasks = [(reference, labels) for labels in label_images]
+            results = pool.map(_match_labels, tasks) if pool else [_match_labels(task) for task in tasks]
+            reglabels = np.array([result[0] for result in results])
+            if show_info:
+                print("Iteration %i, mean matched number: %f" % (i, np.mean([result[1] for result in results])))
+            if not use_consensus:
+                break
+
+            consensus = _mode_labels(reglabels)
+            if np.array_equal(consensus, reference):
+                break
+            reference = consensus
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return reglabels, reference
+
+
 def label_distribute(labels, faces):
     """
     Get connected components numbers of labels, return in a list.
@@ -213,10 +320,6 @@ def label_distribute(labels, faces):
     ------
     list of connected conponents numbers.
     """
-    label_list = np.unique(labels)
-    result = np.zeros_like(label_list)
-    for i, label_num in enumerate(label_list):
-        vertexes = np.where(labels == label_num)[0]
-        numbers = np.unique(connected_components_labeling(vertexes, faces)).shape[0]
-        result[i] = numbers
+    _, component_labels = label_components(labels, faces)
+    _, result = np.unique(component_labels, return_counts=True)
     return result
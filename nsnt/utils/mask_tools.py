@@ -0,0 +1,114 @@
+"""
+Provide mask of vertices, used to compress data(labels, faces, adjacency matrix) into the
+region of interest, and expand it back.
+"""
+import numpy as np
+from scipy import sparse
+
+
+class VertexMask(object):
+    """
+    Mask of vertices, index arrays are calculated once and shared by all operations.
+
+    Parameters
+    ----------
+    mask: binary array, 1 for region of interest and 0 for others, shape = (n_vertices,).
+
+    Attributes
+    ----------
+    n_vertices: number of vertices before mask.
+    keep: index of vertices in region of interest, shape = (n_keep,).
+    drop: index of vertices out of region of interest, shape = (n_vertices - n_keep,).
+    reindex: index of every vertex after mask, -1 for dropped vertex, shape = (n_vertices,).
+    """
+    def __init__(self, mask):
+        mask = np.reshape(mask, (-1))
+        if np.any((mask != 0) & (mask != 1)):
+            raise ValueError('value of mask should be 0 or 1.')
+        self.mask = mask
+        self.n_vertices = mask.shape[0]
+        self.keep = np.where(mask == 1)[0]
+        self.drop = np.where(mask != 1)[0]
+        self.reindex = -np.ones(self.n_vertices, dtype=int)
+        self.reindex[self.keep] = np.arange(self.keep.shape[0])
+
+    @property
+    def n_keep(self):
+        """Number of vertices in region of interest."""
+        return self.keep.shape[0]
+
+    def compress(self, data):
+        """
+        Keep data of vertices in region of interest.
+
+        Parameters
+        ----------
+        data: data(or labels) of vertices, shape = (n_vertices, ...).
+
+        Returns
+        -------
+        data: data after mask, shape = (n_keep, ...).
+        """
+        return np.asarray(data)[self.keep]
+
+    def expand(self, data, fill=0):
+        """
+        Put data of vertices in region of interest back to all vertices.
+
+        Parameters
+        ----------
+        data: data(or labels) after mask, shape = (n_keep, ...).
+        fill: value of vertices out of region of interest, default is 0.
+
+        Returns
+        -------
+        result: data of all vertices, shape = (n_vertices, ...).
+        """
+        data = np.asarray(data)
+        result = np.full((self.n_vertices,) + data.shape[1:], fill, dtype=np.result_type(data, np.min_scalar_type(fill)))
+        result[self.keep] = data
+        return result
+
+    def compress_faces(self, faces, reindex=False):
+        """
+        Remove faces(or edges) that contain vertices out of region of interest.
+
+        Parameters
+        ----------
+        faces: faces or edges of vertices, shape = (n_faces, 3) or (n_edges, 2).
+        reindex: whether renumber vertices by index after mask or not, default is False.
+
+        Returns
+        -------
+        faces: faces(or edges) after mask, shape may change.
+        """
+        faces = np.asarray(faces)
+        inside = np.all(self.mask[faces.astype(int)] == 1, axis=1)
+        faces = faces[inside]
+        if reindex:
+            return self.reindex[faces.astype(int)]
+        return faces
+
+    def compress_adjmatrix(self, adjm):
+        """
+        Keep rows and columns of vertices in region of interest.
+
+        Parameters
+        ----------
+        adjm: adjacency matrix, array or sparse matrix, shape = (n_vertices, n_vertices).
+
+        Returns
+        -------
+        adjm: adjacency matrix after mask, shape = (n_keep, n_keep).
+        """
+        if sparse.issparse(adjm):
+            adjm = sparse.csr_matrix(adjm)
+            return adjm[self.keep][:, self.keep]
+        return np.asarray(adjm)[np.ix_(self.keep, self.keep)]
+
+
+def as_vertex_mask(mask):
+    """Get VertexMask of mask, return None if mask is None."""
+    if mask is None or isinstance(mask, VertexMask):
+        return mask
+    return VertexMask(mask)
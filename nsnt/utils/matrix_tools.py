@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 
 from nsnt.utils.adj_tools import SurfaceGeometry
 
@@ -101,14 +102,19 @@ class MatrixFunction:
             print("adjacency constrain has already been done.")
             return smatrix, 0
 
-        if not adjm:
+        if adjm is None:
             surface_geo = SurfaceGeometry(subj_id, hemi, surf)
             adjm = surface_geo.adjmatrix
 
-        if zeros:
-            adjm = np.delete(adjm, zeros, axis=0)
-            adjm = np.delete(adjm, zeros, axis=1)
-        smatrix = smatrix * adjm
+        # del_zeros() returns 0 when nothing is deleted.
+        zeros = np.array([], dtype=int) if zeros is None or np.isscalar(zeros) else np.atleast_1d(zeros)
+        if zeros.size:
+            keep = np.setdiff1d(np.arange(adjm.shape[0]), zeros)
+            adjm = adjm[keep][:, keep]
+        if sparse.issparse(adjm):
+            smatrix = adjm.multiply(smatrix).toarray()
+        else:
+            smatrix = smatrix * adjm
 
         self.state[state] = True
         return smatrix, adjm
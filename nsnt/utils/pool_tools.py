@@ -0,0 +1,61 @@
+"""
+Provide tools to run tasks in a process pool, with data shared by all tasks.
+"""
+import multiprocessing
+
+# shared data of the worker process, see _init_worker().
+_worker_shared = {}
+
+
+def _init_worker(shared, initializer):
+    """Save shared data once in the worker process, build it by initializer if it's not None."""
+    _worker_shared['shared'] = shared if initializer is None else initializer(shared)
+
+
+def _run_task(args):
+    func, task = args
+    return func(_worker_shared['shared'], task)
+
+
+def shared_map(func, tasks, shared=None, initializer=None, n_jobs=1, ordered=True):
+    """
+    Run func(shared, task) for every task, shared data is sent to every worker process only once.
+
+    Parameters
+    ----------
+    func: module level function, func(shared, task).
+    tasks: sequence of tasks.
+    shared: data shared by all tasks, default is None.
+    initializer: module level function, if it's not None, shared data used by func is
+        initializer(shared), which is called once in every worker process, default is None.
+    n_jobs: number of worker processes, default is 1, means run tasks in the calling process.
+    ordered: whether yield results in the order of tasks or not, default is True.
+
+    Returns
+    -------
+    results: generator of results of tasks.
+
+    Notes
+    -----
+    1. shared data is not saved in the calling process, so it's released when all tasks are done.
+    2. if an error occurs or the generator is closed early, worker processes are terminated,
+       else the pool is closed and joined after all tasks are done.
+    """
+    if n_jobs == 1:
+        shared = shared if initializer is None else initializer(shared)
+        for task in tasks:
+            yield func(shared, task)
+        return
+
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(shared, initializer))
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for result in imap(_run_task, [(func, task) for task in tasks]):
+            yield result
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
@@ -0,0 +1,187 @@
+"""
+Provide tools to reduce data of vertices to labels(segments), like sum, mean and variance of every label,
+and the co-assignment(vote) matrix of repeated label images.
+"""
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+
+def label_onehot(labels, dtype=np.float64):
+    """
+    Build one-hot matrix of labels.
+
+    Parameters
+    ----------
+    labels: labels of vertices, shape = (n_vertices, ).
+    dtype: data type of the one-hot matrix, default is np.float64.
+
+    Returns
+    -------
+    label_list: sorted unique labels, shape = (n_labels, ).
+    onehot: sparse matrix(CSR), onehot[i, j] = 1 if vertex j belongs to label_list[i],
+        shape = (n_labels, n_vertices).
+    """
+    labels = np.reshape(labels, (-1))
+    label_list, label_index = np.unique(labels, return_inverse=True)
+    n_vertices = labels.shape[0]
+    onehot = sparse.csr_matrix((np.ones(n_vertices, dtype=dtype), (label_index, np.arange(n_vertices))),
+                               shape=(label_list.shape[0], n_vertices))
+    return label_list, onehot
+
+
+def segment_stats(data, labels, dtype=np.float64, chunk_size=None, variance=True):
+    """
+    Calculate sum, mean, variance and count of data in every label in one pass over data.
+
+    Parameters
+    ----------
+    data: data of vertices, shape = (n_vertices, ) or (n_vertices, n_features).
+    labels: labels of vertices, shape = (n_vertices, ).
+    dtype: data type used in calculation and of the results, default is np.float64,
+        np.float32 halves the memory of large time series.
+    chunk_size: number of features calculated together, default is None, means all features.
+    variance: whether calculate variance or not, default is True.
+
+    Returns
+    -------
+    label_list: sorted unique labels, shape = (n_labels, ).
+    sums: sum of data in every label, shape = (n_labels, ) or (n_labels, n_features).
+    means: mean of data in every label, same shape as sums.
+    variances: variance(ddof=0) of data in every label, same shape as sums, None if variance is False.
+    counts: number of vertices in every label, shape = (n_labels, ).
+
+    Notes
+    -----
+    1. variance is calculated by centered data of every chunk, so it's numerically stable.
+    """
+    labels = np.reshape(labels, (-1))
+    n_vertices = labels.shape[0]
+    label_list, onehot = label_onehot(labels, dtype=dtype)
+    label_index = np.searchsorted(label_list, labels)
+    counts = np.diff(onehot.indptr)
+
+    data = np.asarray(data)
+    data_2d = np.reshape(data, (n_vertices, -1))
+    n_features = data_2d.shape[1]
+    if chunk_size is None:
+        chunk_size = max(n_features, 1)
+
+    sums = np.zeros((label_list.shape[0], n_features), dtype=dtype)
+    means = np.zeros_like(sums)
+    variances = np.zeros_like(sums) if variance else None
+    for start in range(0, n_features, chunk_size):
+        columns = slice(start, start + chunk_size)
+        chunk = data_2d[:, columns].astype(dtype, copy=False)
+        sums[:, columns] = onehot.dot(chunk)
+        means[:, columns] = sums[:, columns] / counts[:, np.newaxis]
+        if variance:
+            centered = chunk - means[label_index, columns]
+            variances[:, columns] = onehot.dot(centered ** 2) / counts[:, np.newaxis]
+
+    shape = (label_list.shape[0],) + data.shape[1:]
+    sums, means = np.reshape(sums, shape), np.reshape(means, shape)
+    if variance:
+        variances = np.reshape(variances, shape)
+    return label_list, sums, means, variances, counts
+
+
+def segment_sum(data, labels, dtype=np.float64, chunk_size=None):
+    """
+    Sum data of vertices in every label, see segment_stats() for details.
+
+    Returns
+    -------
+    label_list: sorted unique labels, shape = (n_labels, ).
+    sums: sum of data in every label, shape = (n_labels, ) or (n_labels, n_features).
+    counts: number of vertices in every label, shape = (n_labels, ).
+    """
+    label_list, sums, _, _, counts = segment_stats(data, labels, dtype=dtype, chunk_size=chunk_size, variance=False)
+    return label_list, sums, counts
+
+
+def segment_mean(data, labels, dtype=np.float64, chunk_size=None):
+    """
+    Calculate mean data of every label, see segment_stats() for details.
+
+    Returns
+    -------
+    label_list: sorted unique labels, shape = (n_labels, ).
+    means: mean of data in every label, shape = (n_labels, ) or (n_labels, n_features).
+    """
+    label_list, _, means, _, _ = segment_stats(data, labels, dtype=dtype, chunk_size=chunk_size, variance=False)
+    return label_list, means
+
+
+class VoteMatrix(object):
+    """
+    Co-assignment(vote) matrix of repeated parcellations, count the times that
+        two vertices are assigned to the same label.
+
+    Every label image is added as a sparse product of its one-hot matrix L (L * L.T),
+        so no dense (n_vertices, n_vertices) matrix is created.
+
+    Parameters
+    ----------
+    n_vertices: number of vertices.
+    dtype: integer dtype of counts, default is np.uint16, which allows 65535 label images.
+
+    Attributes
+    ----------
+    matrix: sparse matrix(CSR) of counts, diagonal is 0, shape = (n_vertices, n_vertices).
+    n_images: number of label images that have been added.
+    """
+    def __init__(self, n_vertices, dtype=np.uint16):
+        self.n_vertices = n_vertices
+        self.dtype = np.dtype(dtype)
+        self.n_images = 0
+        self.matrix = sparse.csr_matrix((n_vertices, n_vertices), dtype=self.dtype)
+
+    def add(self, label_image):
+        """
+        Add a label image into vote matrix.
+
+        Parameters
+        ----------
+        label_image: labels of vertices, shape = (n_vertices, ).
+        """
+        label_image = np.reshape(label_image, (-1))
+        assert label_image.shape[0] == self.n_vertices, \
+            'label_image should have {0} vertices, got {1}'.format(self.n_vertices, label_image.shape[0])
+        if self.n_images >= np.iinfo(self.dtype).max:
+            raise ValueError('Number of label images exceeds the max count of {}.'.format(self.dtype))
+
+        _, onehot = label_onehot(label_image, dtype=self.dtype)
+        votes = onehot.T.dot(onehot) - sparse.identity(self.n_vertices, dtype=self.dtype, format='csr')
+        votes.eliminate_zeros()
+        self.matrix = self.matrix + votes
+        self.n_images += 1
+
+    def update(self, label_images):
+        """Add label images into vote matrix, label_images is an iterable of label image."""
+        for label_image in label_images:
+            self.add(label_image)
+
+    def save(self, filepath):
+        """
+        Save vote matrix as sparse npz file, load it by scipy.sparse.load_npz().
+
+        The matrix is written to a temporary file in the same directory and then moved
+        to filepath, so an interrupted save never leaves a truncated file at filepath.
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(filepath)))
+        os.close(fd)
+        try:
+            sparse.save_npz(tmp_path, self.matrix)
+            # mkstemp() creates file with mode 0600, give it the default permission of new files.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        print("Saving {}".format(filepath))
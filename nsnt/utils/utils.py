@@ -10,6 +10,8 @@ from time import time
 
 import numpy as np
 
+from nsnt.utils.mask_tools import VertexMask
+
 
 def running_time(func):
     @functools.wraps(func)
@@ -150,7 +152,7 @@ def apply_1d_mask(data, mask):
     Parameters
     ----------
     data: array or sequence, length of its first dim should b equal to length of mask.
-    mask: binary array, 1 for region of interest and 0 for others, shape=(n_vertices,).
+    mask: binary array(or VertexMask), 1 for region of interest and 0 for others, shape=(n_vertices,).
 
     Return
     ------
@@ -158,6 +160,8 @@ def apply_1d_mask(data, mask):
     """
     if mask is None:
         return data
+    if isinstance(mask, VertexMask):
+        return np.copy(mask.compress(data))
 
     if np.any(mask < 0) or np.any(mask > 1):
         raise ValueError('value of mask should be 0 or 1.')
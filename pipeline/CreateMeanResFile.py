@@ -1,14 +1,30 @@
-import nibabel as nib
 import os
+import multiprocessing
+
+import nibabel as nib
 import numpy as np
 from nsnt.utils.utils import check_dir
 import scipy.stats as stats
 
 
+def _load_zscore(task):
+    """Load res file of a session and do zscore, used in worker process."""
+    runid, filepath = task
+    print("loading %s" % filepath)
+    result_run = nib.load(filepath)
+    result_data = stats.zscore(result_run.get_data()[:, 0, 0, :], axis=1)  # doing zscore before average.
+    return runid, result_data, result_run.shape, result_run.get_header()
+
+
 # TODO this method rely on freesurfer data struct heavily, so it's hard to expand its usage.
-def avgerage_brainimg_pr(projectdir, sessidlist, funcname, analysis_name, runlist, savepath, outfmt="mgz"):
+def avgerage_brainimg_pr(projectdir, sessidlist, funcname, analysis_name, runlist, savepath, outfmt="mgz",
+                         n_jobs=1):
     """Average result per run after doing zscore, doing to all sessions.
 
+    Sessions are loaded and z-scored in a pool of worker processes, and folded into
+    a running mean of its run in the parent process, so only about one session per
+    worker is kept in memory, and different runs are processed concurrently.
+
     Parameters
     ----------
         projectdir: name of where your session data placed, type: str.
@@ -18,34 +34,56 @@ def avgerage_brainimg_pr(projectdir, sessidlist, funcname, analysis_name, runlis
         runlist: list of runid.
         savepath: dir of where to put average result file.
         outfmt: suffix of out file.
+        n_jobs: number of worker processes, default is 1.
     """
+    check_dir(savepath)
+    tasks = []
     for runid in runlist:
         prid = "pr%s" % runid
-
-        check_dir(savepath)
-        result_name = "mean_res_%s.%s" % (runid, outfmt)
-        result_path = os.path.join(savepath, result_name)
-
-        data = []
         for sessid in sessidlist:
             fileroot = os.path.join(projectdir, sessid, funcname, analysis_name, prid, "res")
             filename = "res-%s.nii.gz" % runid
-            filepath = os.path.join(fileroot, filename)
+            tasks.append((runid, os.path.join(fileroot, filename)))
+
+    pool = None
+    if n_jobs == 1:
+        results = map(_load_zscore, tasks)
+    else:
+        pool = multiprocessing.Pool(n_jobs)
+        results = pool.imap_unordered(_load_zscore, tasks)
 
-            print("loading %s" % filepath)
-            result_run = nib.load(filepath)
-            result_data = stats.zscore(result_run.get_data()[:, 0, 0, :], axis=1)  # doing zscore before average.
-            data.append(result_data)
-        print("Shape of img: {}: ".format(np.shape(data)))
-        avg_data = np.mean(data, axis=0)
-        print("Shape of avg_data: {}: ".format(np.shape(avg_data)))
+    try:
+        avg_data = {}
+        counts = dict((runid, 0) for runid in runlist)
+        for runid, result_data, shape, header in results:
+            # running mean, avg = avg + (x - avg) / n
+            counts[runid] += 1
+            if runid not in avg_data:
+                avg_data[runid] = np.asarray(result_data, dtype=np.float64)
+            else:
+                avg_data[runid] += (result_data - avg_data[runid]) / counts[runid]
+            del result_data
 
-        avg_data = np.reshape(avg_data, result_run.shape)
-        data_file = nib.MGHImage(avg_data, None, result_run.get_header())
+            if counts[runid] < len(sessidlist):
+                continue
+            result_path = os.path.join(savepath, "mean_res_%s.%s" % (runid, outfmt))
+            print("Shape of avg_data: {}: ".format(np.shape(avg_data[runid])))
+            data_file = nib.MGHImage(np.reshape(avg_data.pop(runid), shape), None, header)
+            nib.save(data_file, result_path)
+            print("Saving %s" % result_path)
+            print("===" * 10)
+    except BaseException:
+        # stop loading the remaining subjects.
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
 
-        nib.save(data_file, result_path)
-        print("Saving %s" % result_path)
-        print("===" * 10)
 
 if __name__ == "__main__":
     projectdir = "/nfs/s1/studyforrest"
@@ -58,4 +96,5 @@ if __name__ == "__main__":
                       'sub015', 'sub016', 'sub017', 'sub018', 'sub019', 'sub020']
         runidlist = ["001", "002", "003", "004", "005", "006", "007", "008"]
         savepath = "/nfs/t3/workingshop/baihaohao/studyforrest/meandata"
-        avgerage_brainimg_pr(projectdir, sessidlist, runidlist, funcname, analysis_name, savepath, outfmt="mgz")
+        avgerage_brainimg_pr(projectdir, sessidlist, funcname, analysis_name, runidlist, savepath, outfmt="mgz",
+                             n_jobs=4)
@@ -0,0 +1,23 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from nsnt.algorithms.permtools import group_isc_test
+
+
+def test_bootstrap_small_group_has_finite_threshold():
+    data = np.random.RandomState(0).randn(3, 4, 50)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        observed, p_values, fwe_threshold = group_isc_test(data, method='bootstrap', n_perms=200,
+                                                           random_state=0)
+    assert np.all(np.isfinite(observed))
+    assert np.all(np.isfinite(p_values))
+    assert np.isfinite(fwe_threshold)
+
+
+def test_bootstrap_needs_three_subjects():
+    data = np.random.RandomState(0).randn(2, 4, 50)
+    with pytest.raises(ValueError):
+        group_isc_test(data, method='bootstrap', n_perms=10)